@@ -0,0 +1,35 @@
+"""Time FacturX.add_line_items() for growing invoices.
+
+The time per line should stay flat as the number of lines grows.
+
+Usage: python -m benchmarks.bench_builder
+"""
+
+import logging
+import os
+
+from facturx import FacturX
+
+from .common import SAMPLE_DIR, best_of
+
+LINE_COUNTS = (500, 1000, 2000, 4000, 8000)
+
+
+def line_items(line_count):
+    return [{'line_id': i, 'name': 'Item %d' % i, 'net_price': '10.00', 'quantity': 2,
+             'amount_total': '20.00', 'tax_category_code': 'S', 'tax_rate': '20.00'}
+            for i in range(1, line_count + 1)]
+
+
+def main():
+    logging.disable(logging.WARNING)
+    factx = FacturX(os.path.join(SAMPLE_DIR, 'no_embedded_data.pdf'), level='en16931')
+    print('%-10s %10s %12s' % ('lines', 'total ms', 'us per line'))
+    for line_count in LINE_COUNTS:
+        items = line_items(line_count)
+        elapsed = best_of(lambda: factx.add_line_items(items, replace=True), repeat=3, number=1)
+        print('%-10d %10.1f %12.2f' % (line_count, elapsed * 1e3, elapsed / line_count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Track start-up cost: import time and one-shot CLI runs in fresh interpreters.
+
+Usage: python -m benchmarks.bench_import [--runs N] [--importtime]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from .common import ROOT_DIR, SAMPLE_DIR
+
+SAMPLE = os.path.join(SAMPLE_DIR, 'Facture_FR_EN16931.pdf')
+SCENARIOS = [
+    ('interpreter', ['-c', 'pass']),
+    ('import facturx', ['-c', 'import facturx']),
+    ('import facturx.facturx', ['-c', 'import facturx.facturx']),
+    ('import bin.cli', ['-c', 'import bin.cli']),
+    ('FacturX(path).to_dict()', ['-c', 'from facturx import FacturX; FacturX(%r).to_dict()' % SAMPLE]),
+    ('facturx validate', ['-m', 'bin.cli', 'validate', SAMPLE]),
+]
+
+
+def time_command(args, runs):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable] + args, cwd=ROOT_DIR,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def import_breakdown(module, limit=10):
+    """Return the slowest imports of module as (cumulative us, name) pairs."""
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        cwd=ROOT_DIR, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True).stderr
+    rows = []
+    for line in output.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def run(runs=10):
+    """Return {scenario: median seconds}."""
+    # Warm-up run so that bytecode and the field map caches exist.
+    time_command(SCENARIOS[-1][1], 1)
+    return dict((name, statistics.median(time_command(args, runs))) for name, args in SCENARIOS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--importtime', action='store_true',
+                        help='also show the slowest imports of facturx.facturx')
+    args = parser.parse_args()
+
+    results = run(args.runs)
+    for name, args_ in SCENARIOS:
+        print('%-30s %8.1f ms' % (name, results[name] * 1e3))
+    if args.importtime:
+        print()
+        for cumulative, name in import_breakdown('facturx.facturx'):
+            print('%8.1f ms %s' % (cumulative / 1e3, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Compare FacturX.to_dict() against one XPath query per field.
+
+Usage: python -m benchmarks.bench_to_dict
+"""
+
+import logging
+
+from facturx import FacturX
+from facturx.flavors import extractor, xml_flavor
+
+from .common import best_of, sample_pdfs, synthetic_xml
+
+LINE_COUNTS = (10, 100, 1000, 5000)
+
+
+def per_field_xpath(xml, flavor):
+    output_dict = {}
+    for field, details in xml_flavor.FIELDS.items():
+        r = xml.xpath(details['_path'][flavor], namespaces=xml.nsmap)
+        output_dict[field] = r[0].text if r else None
+    return output_dict
+
+
+def compare(label, xml, flavor='factur-x'):
+    field_extractor = extractor.get_extractor(flavor)
+    assert field_extractor.extract(xml) == per_field_xpath(xml, flavor)
+    before = best_of(lambda: per_field_xpath(xml, flavor))
+    after = best_of(lambda: field_extractor.extract(xml))
+    print('%-45s %10.1f %10.1f %7.1fx' % (label, before * 1e6, after * 1e6, before / after))
+
+
+def main():
+    logging.disable(logging.WARNING)
+    print('%-45s %10s %10s %8s' % ('invoice', 'xpath us', 'trie us', 'speedup'))
+    for path in sample_pdfs():
+        factx = FacturX(path)
+        compare(path.rsplit('/', 1)[-1], factx.xml)
+    for line_count in LINE_COUNTS:
+        compare('synthetic EN16931, %d lines' % line_count, synthetic_xml(line_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Time reading line amounts and checking the totals of growing invoices.
+
+Compares the columnar reader of FacturX.check_totals() with a loop
+calling find() on every line item.
+
+Usage: python -m benchmarks.bench_totals
+"""
+
+import logging
+from decimal import Decimal
+
+from facturx import totals
+from facturx.flavors import columns
+
+from .common import RAM_NS, best_of, synthetic_xml
+
+LINE_COUNTS = (500, 1000, 2000, 4000, 8000)
+
+_LINE_TAG = '{%s}IncludedSupplyChainTradeLineItem' % RAM_NS
+_AMOUNT_PATH = '{0}SpecifiedLineTradeSettlement/{0}SpecifiedTradeSettlementLineMonetarySummation/{0}LineTotalAmount'.format(
+    '{%s}' % RAM_NS)
+
+
+def loop_sum(xml):
+    return sum(Decimal(line.find(_AMOUNT_PATH).text) for line in xml.iter(_LINE_TAG))
+
+
+def columnar_check(xml):
+    line_items = columns.get_reader('factur-x', 'line_items').read(xml, ['amount_total'])
+    tax_lines = columns.get_reader('factur-x', 'tax_lines').read(
+        xml, ['basis_amount', 'rate', 'calculated_amount'])
+    return totals.check_totals(line_items, tax_lines, None, None)
+
+
+def main():
+    logging.disable(logging.WARNING)
+    print('%-10s %12s %12s' % ('lines', 'loop ms', 'columnar ms'))
+    for line_count in LINE_COUNTS:
+        xml = synthetic_xml(line_count)
+        loop = best_of(lambda: loop_sum(xml), repeat=3)
+        columnar = best_of(lambda: columnar_check(xml), repeat=3)
+        print('%-10d %12.2f %12.2f' % (line_count, loop * 1e3, columnar * 1e3))
+
+
+if __name__ == '__main__':
+    main()
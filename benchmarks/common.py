@@ -0,0 +1,50 @@
+"""Shared helpers for the benchmark scripts.
+
+Everything here runs offline against the invoices shipped in the
+repository; synthetic invoices are derived from the EN16931 sample XML.
+"""
+
+import copy
+import os
+import timeit
+
+from lxml import etree
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_DIR = os.path.join(ROOT_DIR, 'facturx', 'tests', 'sample_invoices')
+EN16931_SAMPLE = os.path.join(
+    ROOT_DIR, 'facturx', 'flavors', 'factur-x', 'xml', 'samples', 'en16931.xml')
+RAM_NS = 'urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100'
+RSM_NS = 'urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100'
+
+
+def sample_pdfs():
+    """Return the paths of the sample invoices, sorted by name."""
+    return [os.path.join(SAMPLE_DIR, name)
+            for name in sorted(os.listdir(SAMPLE_DIR)) if name.endswith('.pdf')]
+
+
+def synthetic_xml(line_count):
+    """Build an EN16931 invoice tree with line_count line items."""
+    parser = etree.XMLParser(remove_blank_text=True)
+    xml = etree.parse(EN16931_SAMPLE, parser).getroot()
+    transaction = xml.find('{%s}SupplyChainTradeTransaction' % RSM_NS)
+    line_tag = '{%s}IncludedSupplyChainTradeLineItem' % RAM_NS
+    template = transaction.find(line_tag)
+    index = transaction.index(template)
+    transaction.remove(template)
+    lines = []
+    for line_id in range(1, line_count + 1):
+        line = copy.deepcopy(template)
+        line.find('.//{%s}LineID' % RAM_NS).text = str(line_id)
+        lines.append(line)
+    transaction[index:index] = lines
+    return xml
+
+
+def best_of(func, repeat=5, number=None):
+    """Return the best per-call time of func in seconds."""
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
@@ -0,0 +1,257 @@
+"""Benchmark suite running each FacturX stage over the sample invoice corpus.
+
+Every stage (FacturX.__init__, is_valid, to_dict, write_pdf, write_xml and
+write_json) runs in its own fresh process over the sample invoices and
+over synthetic EN16931 invoices with many line items. For each stage and
+corpus it reports throughput, p50/p99 latency and the peak RSS while the
+stage's calls run.
+
+Usage:
+  python -m benchmarks.run                       # print results
+  python -m benchmarks.run --save default        # store benchmarks/baselines/default.json
+  python -m benchmarks.run --compare default     # fail on regressions against it
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from functools import partial
+
+from .common import sample_pdfs, synthetic_xml
+
+STAGES = ('init', 'is_valid', 'to_dict', 'write_pdf', 'write_xml', 'write_json')
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+BASE_PDF = 'no_embedded_data.pdf'
+
+
+def make_synthetic_pdfs(directory, line_counts):
+    """Write one PDF per line count with a synthetic EN16931 invoice embedded."""
+    from facturx import FacturX
+    from facturx.flavors import xml_flavor
+
+    base_pdf = [path for path in sample_pdfs() if path.endswith(BASE_PDF)][0]
+    paths = {}
+    for line_count in line_counts:
+        factx = FacturX(base_pdf)
+        factx.xml = synthetic_xml(line_count)
+        factx.flavor = xml_flavor.XMLFlavor(factx.xml)
+        paths[line_count] = os.path.join(directory, 'synthetic_%d.pdf' % line_count)
+        factx.write_pdf(paths[line_count])
+    return paths
+
+
+def _percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(fraction * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def _to_ms(seconds):
+    return None if seconds is None else seconds * 1e3
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process; return whether it worked.
+
+    ru_maxrss of a forked or spawned child starts from the high-water
+    mark of its parent, so the peak of a stage is read from VmHWM after
+    resetting it (Linux only).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb(reset):
+    if reset:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _write_json(factx, path):
+    # FacturX.write_json() only writes valid invoices, which most of the
+    # samples are not: time the export itself.
+    with open(path, 'w') as f:
+        json.dump(factx.to_dict(), f, indent=4, sort_keys=True)
+
+
+def run_stage(stage, paths, repeat, output_dir):
+    """Time one stage over paths; meant to run in a fresh process.
+
+    The peak RSS is the highest one seen while the timed calls run. The
+    invoice is parsed before the peak is reset, so only the init stage
+    includes parsing. Without /proc/self/clear_refs it is the peak of the
+    whole process.
+    """
+    logging.disable(logging.WARNING)
+    from facturx import FacturX
+
+    output_base = os.path.join(output_dir, '%s-%d' % (stage, os.getpid()))
+    latencies = []
+    errors = 0
+    peak_rss_kb = 0
+    for path in paths:
+        for i in range(repeat):
+            if stage == 'init':
+                func = partial(FacturX, path)
+            else:
+                factx = FacturX(path)
+                if stage == 'is_valid':
+                    func = factx.is_valid
+                elif stage == 'to_dict':
+                    func = factx.to_dict
+                elif stage == 'write_pdf':
+                    func = partial(factx.write_pdf, output_base + '.pdf')
+                elif stage == 'write_xml':
+                    func = partial(factx.write_xml, output_base + '.xml')
+                elif stage == 'write_json':
+                    func = partial(_write_json, factx, output_base + '.json')
+            reset = _reset_peak_rss()
+            start = time.perf_counter()
+            try:
+                func()
+                elapsed = time.perf_counter() - start
+            except Exception:
+                # e.g. write_pdf on an invoice created from the template
+                # without a date; reported, not timed.
+                errors += 1
+                continue
+            finally:
+                peak_rss_kb = max(peak_rss_kb, _peak_rss_kb(reset))
+            latencies.append(elapsed)
+
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'calls': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / total if total else 0.0,
+        'p50_ms': _to_ms(_percentile(latencies, 0.50)),
+        'p99_ms': _to_ms(_percentile(latencies, 0.99)),
+        'peak_rss_kb': peak_rss_kb,
+    }
+
+
+def run(stages=STAGES, repeat=5, line_counts=(100, 1000, 5000)):
+    """Run the suite and return the results as a JSON-serializable dict."""
+    work_dir = tempfile.mkdtemp(prefix='facturx-bench-')
+    try:
+        # Every stage and the corpus builder run in a fresh interpreter,
+        # so the parent never holds the large synthetic invoices.
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            synthetic = executor.submit(make_synthetic_pdfs, work_dir, line_counts).result()
+        corpora = [('samples', sample_pdfs())]
+        corpora += [('synthetic-%d' % count, [synthetic[count]]) for count in line_counts]
+
+        results = {}
+        for stage in stages:
+            results[stage] = {}
+            for corpus, paths in corpora:
+                with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                    results[stage][corpus] = executor.submit(
+                        run_stage, stage, paths, repeat, work_dir).result()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    import lxml.etree
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'lxml': '.'.join(str(part) for part in lxml.etree.LXML_VERSION),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regression messages of results against baseline.
+
+    Only p50 latency and peak RSS are compared: p99 over a few calls is
+    too noisy to gate on.
+    """
+    regressions = []
+    for stage, corpora in results['results'].items():
+        for corpus, current in corpora.items():
+            previous = baseline['results'].get(stage, {}).get(corpus)
+            if previous is None:
+                continue
+            for metric in ('p50_ms', 'peak_rss_kb'):
+                if not previous[metric] or current[metric] is None:
+                    continue
+                if current[metric] > previous[metric] * (1 + tolerance):
+                    regressions.append('%s/%s %s: %.1f -> %.1f (+%.0f%%)' % (
+                        stage, corpus, metric, previous[metric], current[metric],
+                        (current[metric] / previous[metric] - 1) * 100))
+    return regressions
+
+
+def print_results(results):
+    print('%-11s %-15s %10s %10s %10s %12s' % (
+        'stage', 'corpus', 'ops/s', 'p50 ms', 'p99 ms', 'peak RSS MB'))
+    for stage, corpora in results['results'].items():
+        for corpus, metrics in corpora.items():
+            if metrics['p50_ms'] is None:
+                print('%-11s %-15s %s' % (stage, corpus, 'all %d calls failed' % metrics['errors']))
+                continue
+            print('%-11s %-15s %10.1f %10.2f %10.2f %12.1f' % (
+                stage, corpus, metrics['throughput'], metrics['p50_ms'],
+                metrics['p99_ms'], metrics['peak_rss_kb'] / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='calls per invoice and stage')
+    parser.add_argument('--lines', type=str, default='100,1000,5000',
+                        help='comma-separated line counts of the synthetic invoices')
+    parser.add_argument('--save', metavar='NAME', help='save results as baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='compare against baselines/NAME.json')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown before reporting a regression')
+    args = parser.parse_args()
+
+    line_counts = [int(count) for count in args.lines.split(',') if count]
+    results = run(args.stages, args.repeat, line_counts)
+    print_results(results)
+
+    if args.save:
+        if not os.path.isdir(BASELINE_DIR):
+            os.makedirs(BASELINE_DIR)
+        with open(os.path.join(BASELINE_DIR, args.save + '.json'), 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, args.compare + '.json')) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,18 @@
-from facturx.facturx import *
 from facturx.logger import logger
+from facturx import batch, bulk, server
+import json
 import logging
 import argparse
+import sys
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='PDF invoice with embedded XML' +
         ' metadata following the Factur-X standard')
+    parser.add_argument('--server', nargs='?', const=server.DEFAULT_SOCKET, default=None,
+                        metavar='SOCKET',
+                        help='send dump, validate and embed to a running "facturx serve"')
     subparsers = parser.add_subparsers(
         help='sub-command help', dest="sub_command")
 
@@ -18,13 +23,141 @@ def main():
     parser_dump.add_argument(
         'output_file', type=str, help='name of export file')
 
+    parser_dump_batch = subparsers.add_parser(
+        'dump-batch', help='dump xml meta data of many pdf invoices to JSON Lines')
+    parser_dump_batch.add_argument('inputs', nargs='*',
+                                   help='pdf invoices, directories or glob patterns')
+    parser_dump_batch.add_argument('--files-from', type=str,
+                                   help='file listing one pdf invoice per line, - for stdin')
+    parser_dump_batch.add_argument('-o', '--output', type=str, default='-',
+                                   help='JSON Lines output file, - for stdout')
+    parser_dump_batch.add_argument('-j', '--processes', type=int, default=None,
+                                   help='number of worker processes, defaults to the CPU count')
+    parser_dump_batch.add_argument('--no-validate', action='store_true',
+                                   help='skip validation of the invoices')
+
     parser_validate = subparsers.add_parser(
         'validate', help='validate xml meta data from pdf invoice')
     parser_validate.add_argument('pdf_invoice', type=argparse.FileType('r'),
                                  help='pdf invoice to validate')
 
+    parser_embed = subparsers.add_parser(
+        'embed', help='embed an xml file in a pdf invoice')
+    parser_embed.add_argument('pdf_invoice', type=argparse.FileType('r'),
+                              help='pdf invoice to embed the xml in')
+    parser_embed.add_argument('xml_file', type=str, help='xml meta data to embed')
+    parser_embed.add_argument('output_file', type=str, help='name of the output pdf')
+    parser_embed.add_argument('--compress', type=int, default=None, metavar='LEVEL',
+                              choices=range(1, 10),
+                              help='store the xml zlib-compressed at this level (1-9)')
+
+    parser_generate = subparsers.add_parser(
+        'generate', help='embed many xml files in copies of one pdf, reporting to JSON Lines')
+    parser_generate.add_argument('base_pdf', type=argparse.FileType('r'),
+                                 help='pdf holding the shared visual representation')
+    parser_generate.add_argument('inputs', nargs='*',
+                                 help='xml files, directories or glob patterns')
+    parser_generate.add_argument('--files-from', type=str,
+                                 help='file listing one xml file per line, - for stdin')
+    parser_generate.add_argument('-o', '--output', type=str, required=True,
+                                 help='output directory, or .zip, .tar, .tar.gz archive')
+    parser_generate.add_argument('--compress', type=int, default=None, metavar='LEVEL',
+                                 choices=range(1, 10),
+                                 help='store the xml zlib-compressed at this level (1-9)')
+
+    parser_index = subparsers.add_parser(
+        'index', help='add new and changed pdf invoices to a sqlite index of their fields')
+    parser_index.add_argument('database', type=str, help='sqlite index, created if missing')
+    parser_index.add_argument('inputs', nargs='*',
+                              help='pdf invoices, directories or glob patterns')
+    parser_index.add_argument('--files-from', type=str,
+                              help='file listing one pdf invoice per line, - for stdin')
+    parser_index.add_argument('-j', '--processes', type=int, default=None,
+                              help='number of worker processes, defaults to the CPU count')
+    parser_index.add_argument('--hash', action='store_true',
+                              help='compare content hashes before re-parsing files with a new mtime')
+    parser_index.add_argument('--prune', action='store_true',
+                              help='forget indexed files that no longer exist')
+
+    parser_query = subparsers.add_parser(
+        'query', help='find invoices in a sqlite index, output as JSON Lines')
+    parser_query.add_argument('database', type=str, help='sqlite index built by "facturx index"')
+    parser_query.add_argument('--seller', type=str, help='start of the seller name')
+    parser_query.add_argument('--buyer', type=str, help='start of the buyer name')
+    parser_query.add_argument('--number', type=str, help='invoice number')
+    parser_query.add_argument('--date-from', type=str, metavar='YYYY-MM-DD')
+    parser_query.add_argument('--date-to', type=str, metavar='YYYY-MM-DD')
+    parser_query.add_argument('--amount-min', type=str, help='minimum total amount')
+    parser_query.add_argument('--amount-max', type=str, help='maximum total amount')
+    parser_query.add_argument('--field', action='append', default=[], metavar='NAME=VALUE',
+                              help='exact value of any other field, may be repeated')
+    parser_query.add_argument('--limit', type=int, default=None)
+
+    parser_serve = subparsers.add_parser(
+        'serve', help='answer dump, validate and embed requests over a Unix socket')
+    parser_serve.add_argument('--socket', type=str, default=server.DEFAULT_SOCKET,
+                              help='socket path, defaults to %(default)s')
+    parser_serve.add_argument('-j', '--processes', type=int, default=None,
+                              help='number of worker processes, defaults to the CPU count')
+
     args = parser.parse_args()
 
+    if args.server and args.sub_command in ('dump', 'validate', 'embed'):
+        params = {}
+        if args.sub_command == 'dump':
+            params['output'] = args.output_file
+        elif args.sub_command == 'embed':
+            params.update(xml=args.xml_file, output=args.output_file, compress_level=args.compress)
+        with server.Client(args.server) as client:
+            response = client.call(args.sub_command, args.pdf_invoice.name, **params)
+        if not response['ok']:
+            logger.error(response['error'])
+            sys.exit(1)
+        if args.sub_command == 'validate' and not response['result']['valid']:
+            logger.warning("%s is not valid", args.pdf_invoice.name)
+        return
+
+    if args.sub_command == 'serve':
+        server.serve(args.socket, args.processes)
+
+    if args.sub_command == 'generate':
+        payloads = batch.expand_paths(args.inputs, files_from=args.files_from, extension='.xml')
+        results = bulk.generate(args.base_pdf.name, payloads, args.output, args.compress)
+        errors = batch.write_jsonl(results, sys.stdout)
+        if errors:
+            logger.error("%d invoice(s) could not be generated", errors)
+            sys.exit(1)
+
+    if args.sub_command in ('index', 'query'):
+        from facturx.index import InvoiceIndex
+
+    if args.sub_command == 'index':
+        paths = batch.expand_paths(args.inputs, files_from=args.files_from)
+        with InvoiceIndex(args.database) as index:
+            stats = index.update(paths, processes=args.processes, use_hash=args.hash)
+            if args.prune:
+                stats['removed'] = index.prune()
+        print(json.dumps(stats, sort_keys=True))
+
+    if args.sub_command == 'query':
+        for field in args.field:
+            if '=' not in field:
+                parser_query.error('--field expects NAME=VALUE, got %r' % field)
+        fields = dict(field.split('=', 1) for field in args.field)
+        with InvoiceIndex(args.database) as index:
+            try:
+                results = index.query(
+                    seller=args.seller, buyer=args.buyer, number=args.number,
+                    date_from=args.date_from, date_to=args.date_to,
+                    amount_min=args.amount_min, amount_max=args.amount_max,
+                    limit=args.limit, **fields)
+            except ValueError as e:
+                parser_query.error(str(e))
+        batch.write_jsonl(results, sys.stdout)
+
+    # Imported after the client mode, which does not need lxml nor PyPDF2.
+    from facturx.facturx import FacturX
+
     if args.sub_command == 'dump':
         factx = FacturX(args.pdf_invoice.name)
         try:
@@ -38,10 +171,27 @@ def main():
         except IndexError:
             logger.error("No extension to output file provided")
 
+    if args.sub_command == 'dump-batch':
+        paths = batch.expand_paths(args.inputs, files_from=args.files_from)
+        results = FacturX.batch(paths, processes=args.processes, validate=not args.no_validate)
+        if args.output == '-':
+            errors = batch.write_jsonl(results, sys.stdout)
+        else:
+            with open(args.output, 'w') as output_file:
+                errors = batch.write_jsonl(results, output_file)
+        if errors:
+            logger.error("%d invoice(s) could not be processed", errors)
+            sys.exit(1)
+
     if args.sub_command == 'validate':
         factx = FacturX(args.pdf_invoice.name)
         factx.is_valid()
 
+    if args.sub_command == 'embed':
+        factx = FacturX(args.pdf_invoice.name)
+        factx.read_xml(args.xml_file)
+        factx.write_pdf(args.output_file, compress_level=args.compress)
+
 
 if __name__ == '__main__':
     main()
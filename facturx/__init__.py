@@ -1,3 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from .facturx import FacturX
\ No newline at end of file
+__all__ = ['FacturX']
+
+
+def __getattr__(name):
+    # Import the main module on first use only, see facturx.facturx
+    if name == 'FacturX':
+        from .facturx import FacturX
+        return FacturX
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
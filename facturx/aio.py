@@ -0,0 +1,83 @@
+"""
+asyncio support: run the blocking parts of FacturX off the event loop.
+
+Parsing, validation and writing are file I/O and CPU-bound lxml/PyPDF2
+work. run() hands them to an executor (the loop's default executor
+unless set_executor() was called) and bounds how many run at once per
+event loop: callers beyond the limit wait on a semaphore before anything
+is submitted, so a burst of requests queues up in the loop instead of
+piling up work and memory in the executor.
+
+    factx = await FacturX.aopen('invoice.pdf')
+    if await factx.ais_valid():
+        await factx.awrite_pdf('out.pdf')
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+from functools import partial
+
+_executor = None
+_limit = os.cpu_count() or 1
+# One semaphore per event loop, as asyncio primitives are bound to a loop.
+_semaphores = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def set_executor(executor):
+    """Run blocking calls on executor (None for the loop's default one)."""
+    global _executor
+    _executor = executor
+
+
+def get_executor():
+    return _executor
+
+
+def set_concurrency(limit):
+    """Allow at most limit blocking calls in flight per event loop.
+
+    Only loops that did not run anything yet pick up the new limit.
+    Loops already running calls keep their semaphore, and so their old
+    limit, so the permits held by calls in flight are always counted.
+    """
+    global _limit
+    if limit < 1:
+        raise ValueError('The concurrency limit must be at least 1.')
+    with _lock:
+        _limit = limit
+
+
+def _get_semaphore(loop):
+    with _lock:
+        semaphore = _semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _semaphores[loop] = asyncio.Semaphore(_limit)
+        return semaphore
+
+
+def _release(semaphore, future):
+    semaphore.release()
+    if not future.cancelled():
+        # Mark the outcome as retrieved when the caller was cancelled.
+        future.exception()
+
+
+async def run(func, *args, **kwargs):
+    """Call func(*args, **kwargs) on the executor and return its result.
+
+    Cancelling the caller does not stop a call already submitted: its
+    permit is only released when the executor is done with it.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _get_semaphore(loop)
+    await semaphore.acquire()
+    try:
+        future = loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+    except BaseException:
+        semaphore.release()
+        raise
+    future.add_done_callback(partial(_release, semaphore))
+    return await asyncio.shield(future)
@@ -0,0 +1,123 @@
+"""
+Bulk extraction of Factur-X data over many PDF invoices.
+
+Each file is parsed, validated and exported to a dict in a worker of a
+process pool. Results come back in input order as soon as they are ready,
+and a failing file produces an error record instead of stopping the batch.
+"""
+
+import glob
+import json
+import os
+import sys
+from functools import partial
+
+from .logger import logger
+
+
+def expand_paths(inputs, files_from=None, extension='.pdf'):
+    """Yield PDF paths from directories, glob patterns and file names.
+
+    Directories are walked recursively for files ending with extension.
+    files_from is an optional path ('-' for stdin) to a list of files,
+    one per line.
+    """
+    for item in inputs:
+        if os.path.isdir(item):
+            for dirpath, dirnames, filenames in os.walk(item):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    # Case-sensitive, like the '.pdf' check of FacturX()
+                    if filename.endswith(extension):
+                        yield os.path.join(dirpath, filename)
+        elif glob.has_magic(item):
+            for path in sorted(glob.glob(item, recursive=True)):
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield item
+    if files_from is not None:
+        list_file = sys.stdin if files_from == '-' else open(files_from)
+        try:
+            for line in list_file:
+                line = line.strip()
+                if line:
+                    yield line
+        finally:
+            if list_file is not sys.stdin:
+                list_file.close()
+
+
+def process_file(path, validate=True):
+    """Parse one invoice and return its result record.
+
+    The record holds the path, flavor, level and fields, plus `valid`
+    when validation is requested. On failure it holds `error` instead.
+    """
+    # Imported here so that pool workers started with 'spawn' pay for it once.
+    from .facturx import FacturX
+
+    try:
+        factx = FacturX(path, use_mmap=True)
+        result = {
+            'path': path,
+            'flavor': factx.flavor.name,
+            'level': factx.flavor.level,
+            'fields': factx.to_dict(),
+        }
+        if validate:
+            result['valid'] = factx.is_valid()
+        return result
+    except Exception as e:
+        logger.warning('Could not process %s: %s', path, e)
+        return {
+            'path': path,
+            'error': '%s: %s' % (type(e).__name__, e),
+        }
+
+
+def iter_batch(paths, processes=None, validate=True, chunksize=1):
+    """Process paths over a pool of processes and yield results in order.
+
+    processes defaults to the number of CPUs; with processes=1 everything
+    runs in the current process.
+    """
+    worker = partial(process_file, validate=validate)
+    return imap(worker, paths, processes=processes, chunksize=chunksize)
+
+
+def imap(worker, items, processes=None, chunksize=1):
+    """Yield worker(item) for each item, in order, computed over a process pool.
+
+    processes defaults to the number of CPUs; with processes=1 everything
+    runs in the current process.
+    """
+    if processes == 1:
+        for item in items:
+            yield worker(item)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(worker, items, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write_jsonl(results, output):
+    """Write result records to output as JSON Lines, one flush per record.
+
+    Returns the number of records holding an error.
+    """
+    errors = 0
+    for result in results:
+        if 'error' in result:
+            errors += 1
+        output.write(json.dumps(result, sort_keys=True))
+        output.write('\n')
+        output.flush()
+    return errors
@@ -0,0 +1,173 @@
+"""
+Bulk generation of Factur-X invoices sharing one visual PDF.
+
+The base PDF is read and parsed by PyPDF2 once. Every XML payload is
+then validated and written as an incremental update appended to the
+unchanged base document (see FacturXIncrementalWriter). Pages, fonts and
+the /OutputIntents ICC profiles are thus reused byte for byte instead of
+being copied object by object for each invoice, and the XMP metadata is
+rendered from the cached template.
+
+Finished PDFs are streamed one at a time to a directory, a zip archive
+or a tar archive, so memory use does not grow with the number of
+invoices.
+
+    for result in bulk.generate('layout.pdf', xml_paths, 'out.zip'):
+        ...
+"""
+
+import io
+import os
+import tarfile
+import time
+import zipfile
+
+from .logger import logger
+
+
+class BulkWriter(object):
+    """Embed many XML payloads in copies of one base PDF."""
+
+    def __init__(self, base_pdf, compress_level=None):
+        from .facturx import FacturX
+        self.factx = FacturX(base_pdf)
+        self.compress_level = compress_level
+        # Only read by the incremental writers, so it can be shared.
+        self._pdf_reader = self.factx._take_pdf_reader()
+
+    def writer(self, xml):
+        """Return a FacturXIncrementalWriter for the XML payload xml.
+
+        xml is a path, a file object or bytes. It replaces the XML of the
+        base document and must be valid against its schema.
+        """
+        from .pdfwriter import FacturXIncrementalWriter
+        if isinstance(xml, bytes):
+            xml = io.BytesIO(xml)
+        self.factx.read_xml(xml)
+        return FacturXIncrementalWriter(
+            self.factx, compress_level=self.compress_level, pdf_reader=self._pdf_reader)
+
+
+class DirectorySink(object):
+    """Write each PDF as a file of directory."""
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    def add(self, name, writer):
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'wb') as f:
+                writer.write(f)
+        except Exception:
+            # Remove the partial file, if open() got as far as creating it.
+            if os.path.isfile(path):
+                os.remove(path)
+            raise
+        return path
+
+    def close(self):
+        pass
+
+
+class ZipSink(object):
+    """Stream each PDF into a zip archive.
+
+    PDFs compress poorly, so members are stored without compression.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+    def add(self, name, writer):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        with self._zip.open(info, 'w') as member:
+            writer.write(member)
+        return '%s:%s' % (self.path, name)
+
+    def close(self):
+        self._zip.close()
+
+
+class TarSink(object):
+    """Add each PDF to a tar archive, gzip-compressed for .tar.gz and .tgz."""
+
+    def __init__(self, path):
+        self.path = path
+        mode = 'w:gz' if path.endswith(('.tar.gz', '.tgz')) else 'w'
+        self._tar = tarfile.open(path, mode)
+
+    def add(self, name, writer):
+        # tar headers need the size up front, so one PDF is built in memory.
+        buf = io.BytesIO()
+        writer.write(buf)
+        info = tarfile.TarInfo(name)
+        info.size = buf.tell()
+        info.mtime = time.time()
+        buf.seek(0)
+        self._tar.addfile(info, buf)
+        return '%s:%s' % (self.path, name)
+
+    def close(self):
+        self._tar.close()
+
+
+def open_sink(output):
+    """Return the sink for output: a .zip, .tar(.gz) or .tgz file, else a directory."""
+    if output.endswith('.zip'):
+        return ZipSink(output)
+    if output.endswith(('.tar', '.tar.gz', '.tgz')):
+        return TarSink(output)
+    return DirectorySink(output)
+
+
+def _payload_name(payload, index):
+    if isinstance(payload, str):
+        return os.path.splitext(os.path.basename(payload))[0] + '.pdf'
+    return 'invoice-%06d.pdf' % index
+
+
+def _unique_name(name, used):
+    """Return name, or name with a -2, -3... suffix if it is in used; add it to used."""
+    base, extension = os.path.splitext(name)
+    count = 1
+    while name in used:
+        count += 1
+        name = '%s-%d%s' % (base, count, extension)
+    used.add(name)
+    return name
+
+
+def generate(base_pdf, payloads, output, compress_level=None):
+    """Embed each payload in a copy of base_pdf and write them to output.
+
+    payloads is an iterable of XML paths, file objects or bytes, or of
+    (name, payload) pairs to choose the name of the PDF. output is a
+    directory or an archive, see open_sink(). Payloads ending up with the
+    same name, like XML files of the same name from different
+    directories, get a -2, -3... suffix. Yields one result dict per
+    payload, holding the name and the output location, or an error.
+    """
+    bulk_writer = BulkWriter(base_pdf, compress_level)
+    sink = open_sink(output)
+    used_names = set()
+    try:
+        for index, payload in enumerate(payloads, 1):
+            if isinstance(payload, tuple):
+                name, payload = payload
+            else:
+                name = _payload_name(payload, index)
+            name = _unique_name(name, used_names)
+            try:
+                location = sink.add(name, bulk_writer.writer(payload))
+            except Exception as e:
+                logger.warning('Could not generate %s: %s', name, e)
+                yield {'name': name, 'error': '%s: %s' % (type(e).__name__, e)}
+            else:
+                yield {'name': name, 'output': location}
+    finally:
+        sink.close()
@@ -1,19 +1,23 @@
 import io
 import json
+import logging
 import os
 import copy
 import os.path
+import shutil
+import tempfile
+import threading
 from datetime import datetime
 from io import BytesIO
 
-import yaml
-from PyPDF2 import PdfFileReader
-from PyPDF2.generic import IndirectObject
 from lxml import etree
 
-from .flavors import xml_flavor
+from . import instrument, xmlparser
+from .flavors import builder, columns, extractor, xml_flavor
 from .logger import logger
-from .pdfwriter import FacturXPDFWriter
+
+# PyPDF2 (through pdfreader and pdfwriter) and PyYAML are imported where
+# they are used, which keeps `import facturx` cheap for short-lived processes.
 
 # Python 2 and 3 compat
 try:
@@ -38,13 +42,35 @@ class FacturX(object):
     - xml: xml tree of machine-readable representation.
     - pdf: underlying graphical PDF representation.
     - flavor: which flavor (Factur-x) to use.
+
+    Pass `use_mmap=True` together with a path to memory-map the PDF instead
+    of loading it in memory, which keeps large scanned invoices cheap;
+    close() releases the map, or use the invoice in a with block.
+
+    With `validate=False` the XML is not checked against its schema when
+    loading; call is_valid() when needed. See also open() and peek().
+
+    Set `validation_cache` (see facturx.validation_cache) to skip
+    validating documents already validated.
     """
 
-    def __init__(self, pdf_invoice, flavor='factur-x', level='minimum'):
+    validation_cache = None
+
+    def __init__(self, pdf_invoice, flavor='factur-x', level='minimum', use_mmap=False, validate=True):
         # Read PDF from path, pointer or string
+        self._pdf_path = None
+        self._pdf_map = None
         if isinstance(pdf_invoice, str) and pdf_invoice.endswith('.pdf') and os.path.isfile(pdf_invoice):
-            with open(pdf_invoice, 'rb') as f:
-                pdf_file = BytesIO(f.read())
+            self._pdf_path = os.path.abspath(pdf_invoice)
+            with instrument.span('pdf.read'):
+                if use_mmap:
+                    from . import pdfreader
+                    pdf_file = self._pdf_map = pdfreader.map_file(pdf_invoice)
+                    instrument.count('bytes.read', len(pdf_file))
+                else:
+                    with open(pdf_invoice, 'rb') as f:
+                        pdf_file = BytesIO(f.read())
+                    instrument.count('bytes.read', len(pdf_file.getvalue()))
         elif isinstance(pdf_invoice, file_types):
             pdf_file = pdf_invoice
         else:
@@ -62,36 +88,146 @@ class FacturX(object):
         else:
             # No metadata embedded. Create from template.
             # 'PDF does not have XML embedded. Adding from template.'
-            self.flavor, self.xml = xml_flavor.XMLFlavor.from_template(flavor, level)
+            with instrument.span('xml.template'):
+                self.flavor, self.xml = xml_flavor.XMLFlavor.from_template(flavor, level)
 
-        self.flavor.check_xsd(self.xml)
+        if validate:
+            self.flavor.check_xsd(self.xml)
         self._namespaces = self.xml.nsmap
 
         self.already_added_field = {}
 
-    def read_xml(self):
-        """Use XML data from external file. Replaces existing XML or template."""
-        pass
+    def close(self):
+        """Release the memory map of a PDF loaded with use_mmap=True.
+
+        The PDF cannot be written once closed.
+        """
+        if self._pdf_map is not None:
+            self._pdf_map.close()
+            self._pdf_map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @classmethod
+    def open(cls, pdf_invoice, validate=False, **kwargs):
+        """Load an invoice without validating it by default.
+
+        Flavor, level and fields are available right away; validation
+        only runs when is_valid() is called.
+        """
+        return cls(pdf_invoice, validate=validate, **kwargs)
+
+    @staticmethod
+    def peek(pdf_invoice, fields=None):
+        """Return the flavor, level and field texts of the embedded XML.
+
+        pdf_invoice is a path or a file object. Only the fields named in
+        fields are read (all of them by default) and values are the raw
+        element texts. Nothing is validated, and None is returned when the
+        PDF holds no Factur-X XML.
+        """
+        from . import pdfreader
+        pdf_map = None
+        if isinstance(pdf_invoice, str):
+            pdf_invoice = pdf_map = pdfreader.map_file(pdf_invoice)
+        try:
+            with instrument.span('pdf.parse'):
+                pdf = pdfreader.PdfFileReader(pdf_invoice)
+            with instrument.span('pdf.extract'):
+                xml_bytes = pdfreader.get_embedded_xml(pdf)
+        finally:
+            if pdf_map is not None:
+                pdf_map.close()
+        if xml_bytes is None:
+            return None
+        with instrument.span('xml.parse'):
+            xml = xmlparser.fromstring(xml_bytes)
+        flavor = xml_flavor.XMLFlavor(xml)
+        with instrument.span('fields.read'):
+            if fields is None:
+                values = extractor.get_extractor(flavor.name).extract(xml)
+            else:
+                values = {}
+                for field_name in fields:
+                    elements = flavor.get_xpath(field_name)(xml)
+                    values[field_name] = elements[0].text if elements else None
+        return {'flavor': flavor.name, 'level': flavor.level, 'fields': values}
+
+    @staticmethod
+    def stream(pdf_invoice, chunk_size=65536):
+        """Yield the header, then each line item, then the trade fields of pdf_invoice.
+
+        For invoices too large to load: the embedded XML is parsed
+        incrementally and each line item is dropped once yielded, see
+        facturx.stream. Nothing is validated.
+        """
+        from . import stream
+        return stream.iter_invoice(pdf_invoice, chunk_size)
+
+    @classmethod
+    def batch(cls, paths, processes=None, validate=True):
+        """Parse, validate and export many invoices over a process pool.
+
+        Yields one result dict per path, in input order. See facturx.batch.
+        """
+        from . import batch
+        return batch.iter_batch(paths, processes=processes, validate=validate)
+
+    @classmethod
+    def aopen(cls, *args, **kwargs):
+        """Awaitable FacturX(*args, **kwargs) running on the executor of facturx.aio."""
+        from . import aio
+        return aio.run(cls, *args, **kwargs)
+
+    def read_xml(self, xml_file):
+        """Use XML data from external file. Replaces existing XML or template.
+
+        xml_file is a path or a file object. The flavor and level are taken
+        from the new XML, which must be valid against its schema.
+        """
+        with instrument.span('xml.parse'):
+            xml = xmlparser.parse(xml_file)
+        flavor = xml_flavor.XMLFlavor(xml)
+        flavor.check_xsd(xml)
+        self.xml = xml
+        self.flavor = flavor
+        self._namespaces = self.xml.nsmap
+        self.already_added_field = {}
 
     def _xml_from_file(self, pdf_file):
-        pdf = PdfFileReader(pdf_file)
-        pdf_root = pdf.trailer['/Root']
-        if '/Names' not in pdf_root or '/EmbeddedFiles' not in pdf_root['/Names']:
-            # 'No existing XML file found.'
+        from . import pdfreader
+        with instrument.span('pdf.parse'):
+            pdf = pdfreader.PdfFileReader(pdf_file)
+        # Kept for FacturXPDFWriter, see _take_pdf_reader()
+        self._pdf_reader = pdf
+        with instrument.span('pdf.extract'):
+            xml_bytes = pdfreader.get_embedded_xml(pdf)
+        if xml_bytes is None:
             return None
+        with instrument.span('xml.parse'):
+            return xmlparser.fromstring(xml_bytes)
 
-        for file in pdf_root['/Names']['/EmbeddedFiles']['/Names']:
-            if isinstance(file, IndirectObject):
-                obj = file.getObject()
-                if obj['/F'] in xml_flavor.valid_xmp_filenames():
-                    xml_root = etree.fromstring(obj['/EF']['/F'].getData())
-                    xml_content = xml_root
+    def _take_pdf_reader(self):
+        """Return a PdfFileReader on self.pdf, reusing the one parsed at load time.
 
-                    return xml_content
+        FacturXPDFWriter rewires the objects it copies from the reader, so
+        the parsed reader is handed out once and later calls parse again.
+        """
+        pdf = getattr(self, '_pdf_reader', None)
+        self._pdf_reader = None
+        if pdf is None:
+            from . import pdfreader
+            with instrument.span('pdf.parse'):
+                pdf = pdfreader.PdfFileReader(self.pdf)
+        return pdf
 
     def __getitem__(self, field_name):
-        path = self.flavor.get_xml_path(field_name)
-        value = self.xml.xpath(path, namespaces=self._namespaces)
+        with instrument.span('fields.read'):
+            value = self.flavor.get_xpath(field_name)(self.xml)
         if value:
             value = value[0].text
         if 'date' in field_name:
@@ -99,11 +235,12 @@ class FacturX(object):
         return value
 
     def __setitem__(self, field_name, value):
-        path = self.flavor.get_xml_path(field_name)
-        res = self.xml.xpath(path, namespaces=self._namespaces)
+        with instrument.span('fields.write'):
+            res = self.flavor.get_xpath(field_name)(self.xml)
         if not res:
             # The node is not defined at all in the parsed xml
-            logger.warning("{} is not defined in {}".format(path, self.flavor.name))
+            logger.warning("{} is not defined in {}".format(
+                self.flavor.get_xml_path(field_name), self.flavor.name))
             return
 
         current_el = res[-1]
@@ -131,24 +268,106 @@ class FacturX(object):
             current_el.text = str(value)
 
     def _save_to_registry(self, current_el, parent_tag):
-        if parent_tag not in self.already_added_field:
-            self.already_added_field[parent_tag] = []
-        elif current_el in self.already_added_field[parent_tag]:
-            self.already_added_field[parent_tag] = [el for el in self.already_added_field[parent_tag] if
-                                                    el != current_el]
+        # One set of elements per parent tag, toggled on each write.
+        registry = self.already_added_field.get(parent_tag)
+        if registry is None:
+            self.already_added_field[parent_tag] = set()
+        elif current_el in registry:
+            registry.discard(current_el)
         else:
-            self.already_added_field[parent_tag].append(current_el)
+            registry.add(current_el)
+
+    def add_line_items(self, items, replace=False):
+        """Append one line item per dict of items, in a single pass.
 
-    def is_valid(self):
+        The keys are the line_items fields of flavors/groups.yml. With
+        replace=True the existing line items (e.g. the empty one of a
+        template) are removed first. Returns the number of items added.
+        Raises ValueError on levels without line items (minimum, basicwl).
+        """
+        return self._add_group('line_items', items, replace)
+
+    def add_tax_lines(self, taxes, replace=False):
+        """Append one tax breakdown per dict of taxes, see add_line_items()."""
+        return self._add_group('tax_lines', taxes, replace)
+
+    def line_items(self, fields=None):
+        """Return the line items as {field name: list of values, one per line}.
+
+        The keys are the line_items fields of flavors/groups.yml, all of
+        them unless restricted to fields. Missing values are None and
+        decimal fields are decimal.Decimal.
+        """
+        return self._read_group('line_items', fields)
+
+    def tax_lines(self, fields=None):
+        """Return the VAT breakdown as columns, see line_items()."""
+        return self._read_group('tax_lines', fields)
+
+    def _read_group(self, group, fields):
+        with instrument.span('fields.read'):
+            return columns.get_reader(self.flavor.name, group).read(self.xml, fields)
+
+    def check_totals(self):
+        """Return the inconsistencies between line, VAT breakdown and header amounts.
+
+        See facturx.totals for the checks; an empty list means none.
+        """
+        from . import totals
+        if not columns.supports(self.flavor.name, 'line_items'):
+            return []
+        return totals.check_totals(
+            self.line_items(['amount_total']),
+            self.tax_lines(['basis_amount', 'rate', 'calculated_amount']),
+            self['amount_untaxed'], self['amount_tax'])
+
+    def _add_group(self, group, items, replace):
+        with instrument.span('fields.write'):
+            return builder.get_builder(self.flavor.name, group).insert(
+                self.xml, items, replace, level=self.flavor.level)
+
+    def is_valid(self, cache=None):
         """Make every effort to validate the current XML.
 
         Checks:
         - all required fields are present and have values.
         - XML is valid
+        - line, VAT breakdown and total amounts add up
         - ...
 
+        cache overrides `FacturX.validation_cache` for this call.
+
         Returns: true/false (validation passed/failed)
         """
+        if cache is None:
+            cache = self.validation_cache
+        with instrument.span('validate'):
+            if cache is None:
+                return self._is_valid()
+
+            from . import validation_cache
+            key = validation_cache.make_key(self.xml, self.flavor.name, self.flavor.level)
+            entry = cache.get(key)
+            if entry is None:
+                entry = {'warnings': [], 'defaults': []}
+                recorder = _WarningRecorder(entry['warnings'])
+                logger.addHandler(recorder)
+                try:
+                    entry['valid'] = self._is_valid(entry['defaults'])
+                finally:
+                    logger.removeHandler(recorder)
+                cache.set(key, entry)
+                return entry['valid']
+
+            instrument.count('validate.cache_hits', 1)
+            for field, default in entry['defaults']:
+                self[field] = default
+            for message in entry['warnings']:
+                logger.warning(message)
+            return entry['valid']
+
+    def _is_valid(self, defaults=None):
+        # Applied defaults are recorded in the given list.
         # validate against XSD
         try:
             self.flavor.check_xsd(self.xml)
@@ -159,10 +378,12 @@ class FacturX(object):
         fields_data = xml_flavor.FIELDS
         for field in fields_data.keys():
             if fields_data[field]['_required']:
-                r = self.xml.xpath(fields_data[field]['_path'][self.flavor.name], namespaces=self._namespaces)
+                r = self.flavor.get_xpath(field)(self.xml)
                 if not len(r) or r[0].text is None:
                     if '_default' in fields_data[field].keys():
                         self[field] = fields_data[field]['_default']
+                        if defaults is not None:
+                            defaults.append((field, fields_data[field]['_default']))
                     else:
                         logger.warning("Required field '%s' is not present", field)
                         return False
@@ -175,43 +396,89 @@ class FacturX(object):
             ('country', 'shipping_country')
         ]
         for code_type, field_name in codes_to_check:
-            if self[field_name] and not self.flavor.valid_code(code_type, self[field_name]):
+            field_value = self[field_name]
+            if field_value and not self.flavor.valid_code(code_type, field_value):
                 logger.warning("Field %s is not a valid %s code." % (field_name, code_type))
                 return False
 
+        # Check that amounts add up
+        for error in self.check_totals():
+            logger.warning('%s', error)
+            return False
+
         return True
 
-    def write_pdf(self, path):
-        pdfwriter = FacturXPDFWriter(self)
-        with open(path, 'wb') as output_f:
-            pdfwriter.write(output_f)
+    def ais_valid(self):
+        """Awaitable is_valid() running on the executor of facturx.aio."""
+        from . import aio
+        return aio.run(self.is_valid)
+
+    def write_pdf(self, path, incremental=False, compress_level=None):
+        """Write the PDF with the current XML embedded to path.
+
+        With incremental=True the original bytes are kept as they are and
+        only the changed objects are appended as an incremental update, so
+        the cost depends on the size of the XML rather than of the PDF.
+        Writing to the file the invoice was loaded from then only appends.
+
+        Pass a zlib compress_level (1-9) to store the embedded XML
+        compressed, which shrinks invoices with many lines a lot.
+        """
+        from .pdfwriter import FacturXPDFWriter, FacturXIncrementalWriter
+        with instrument.span('pdf.write'):
+            same_file = (self._pdf_path is not None and os.path.exists(path)
+                         and os.path.samefile(path, self._pdf_path))
+            if incremental:
+                pdfwriter = FacturXIncrementalWriter(self, compress_level=compress_level)
+                if same_file:
+                    instrument.count('bytes.written', pdfwriter.append_to(path))
+                    return True
+            else:
+                pdfwriter = FacturXPDFWriter(self, compress_level=compress_level)
+            if not same_file:
+                self._write_pdf_to(pdfwriter, path)
+                return True
+
+            # The writers read the source while writing, through its memory
+            # map with use_mmap=True: write next to it, then move in place.
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)), prefix='.', suffix='.pdf.tmp')
+            os.close(fd)
+            try:
+                self._write_pdf_to(pdfwriter, tmp_path)
+                shutil.copymode(path, tmp_path)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
         return True
 
+    def _write_pdf_to(self, pdfwriter, path):
+        with open(path, 'wb') as output_f:
+            with instrument.span('pdf.serialize'):
+                pdfwriter.write(output_f)
+            instrument.count('bytes.written', output_f.tell())
+
+    def awrite_pdf(self, path, incremental=False, compress_level=None):
+        """Awaitable write_pdf() running on the executor of facturx.aio."""
+        from . import aio
+        return aio.run(self.write_pdf, path, incremental=incremental, compress_level=compress_level)
+
     @property
     def xml_str(self):
         """Calculate MD5 checksum of XML file. Used for PDF attachment."""
-        return etree.tostring(self.xml, pretty_print=True)
+        with instrument.span('xml.serialize'):
+            return etree.tostring(self.xml, pretty_print=True)
 
     def write_xml(self, path):
         with open(path, 'wb') as f:
             f.write(self.xml_str)
+            instrument.count('bytes.written', f.tell())
 
     def to_dict(self):
         """Get all available fields as dict."""
-        fields_data = xml_flavor.FIELDS
-        flavor = self.flavor.name
-
-        output_dict = {}
-        for field in fields_data.keys():
-            try:
-                if fields_data[field]['_path'][flavor] is not None:
-                    r = self.xml.xpath(fields_data[field]['_path'][flavor],
-                                       namespaces=self._namespaces)
-                    output_dict[field] = r[0].text
-            except IndexError:
-                output_dict[field] = None
-
-        return output_dict
+        with instrument.span('fields.to_dict'):
+            return extractor.get_extractor(self.flavor.name).extract(self.xml)
 
     def write_json(self, json_file_path='output.json'):
         json_output = self.to_dict()
@@ -219,10 +486,26 @@ class FacturX(object):
             with open(json_file_path, 'w') as json_file:
                 logger.info("Exporting JSON to %s", json_file_path)
                 json.dump(json_output, json_file, indent=4, sort_keys=True)
+                instrument.count('bytes.written', json_file.tell())
 
     def write_yaml(self, yml_file_path='output.yml'):
+        import yaml
         yml_output = self.to_dict()
         if self.is_valid():
             with open(yml_file_path, 'w') as yml_file:
                 logger.info("Exporting YAML to %s", yml_file_path)
                 yaml.dump(yml_output, yml_file, default_flow_style=False)
+                instrument.count('bytes.written', yml_file.tell())
+
+
+class _WarningRecorder(logging.Handler):
+    """Collect the messages of the warnings logged by the current thread."""
+
+    def __init__(self, messages):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = messages
+        self.thread = threading.get_ident()
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.messages.append(record.getMessage())
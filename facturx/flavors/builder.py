@@ -0,0 +1,187 @@
+"""
+Bulk creation of repeated groups (line items, tax breakdown).
+
+The fields of a group in groups.yml are compiled once per flavor into a
+tree of element tags in XSD order. Each item dict is turned into one
+group element by walking that tree, creating only the branches holding
+a value, and all new elements are inserted into the document with a
+single slice assignment. Adding n items is therefore O(n), where setting
+fields one by one through FacturX.__setitem__ copies a whole group per
+item.
+
+The same tree reads group elements back, see GroupBuilder.read().
+"""
+
+from lxml import etree
+
+from . import xml_flavor
+
+
+class _PlanNode(object):
+    __slots__ = ('tag', 'children', 'by_tag', 'field', 'attributes', 'all_fields')
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.children = []
+        self.by_tag = {}
+        self.field = None
+        self.attributes = []
+        self.all_fields = set()
+
+    def child(self, tag):
+        node = self.by_tag.get(tag)
+        if node is None:
+            node = self.by_tag[tag] = _PlanNode(tag)
+            self.children.append(node)
+        return node
+
+
+def _clark(step, namespaces):
+    prefix, sep, local_name = step.rpartition(':')
+    if not sep:
+        return local_name
+    return '{%s}%s' % (namespaces[prefix], local_name)
+
+
+class GroupBuilder(object):
+    """Create the elements of one group of groups.yml for a flavor."""
+
+    def __init__(self, flavor, group):
+        definition = xml_flavor.GROUPS[group]
+        namespaces = xml_flavor.FLAVORS[flavor]['namespaces']
+        self.flavor = flavor
+        self.group = group
+        self._namespaces = namespaces
+
+        steps = definition['_path'][flavor].lstrip('/').split('/')
+        self.parent_path = '/' + '/'.join(steps[:-1])
+        self.tag = _clark(steps[-1], namespaces)
+        self.followed_by = frozenset(
+            _clark(step, namespaces) for step in definition.get('_followed_by', {}).get(flavor, []))
+        levels = definition.get('_levels', {}).get(flavor)
+        self.levels = frozenset(levels) if levels is not None else None
+
+        self.field_names = []
+        self.required = []
+        self.defaults = {}
+        self._plan = _PlanNode(self.tag)
+        for field_name, details in definition['_fields'].items():
+            if flavor not in details['_path']:
+                continue
+            self.field_names.append(field_name)
+            if details.get('_required'):
+                self.required.append(field_name)
+            if '_default' in details:
+                self.defaults[field_name] = str(details['_default'])
+            node = self._plan
+            node.all_fields.add(field_name)
+            field_steps = details['_path'][flavor].split('/')
+            for step in field_steps:
+                if step.startswith('@'):
+                    node.attributes.append((step[1:], field_name))
+                    break
+                node = node.child(_clark(step, namespaces))
+                node.all_fields.add(field_name)
+            else:
+                node.field = field_name
+        self._known = frozenset(self.field_names)
+
+    def _values(self, item):
+        unknown = set(item) - self._known
+        if unknown:
+            raise ValueError('Unknown %s field(s): %s' % (self.group, ', '.join(sorted(unknown))))
+        values = dict(self.defaults)
+        for key, value in item.items():
+            if value is not None:
+                values[key] = str(value)
+        for field_name in self.required:
+            if field_name not in values:
+                raise ValueError('Required %s field %r is missing' % (self.group, field_name))
+        return values
+
+    def _build(self, parent, node, values):
+        element = etree.SubElement(parent, node.tag)
+        if node.field is not None and node.field in values:
+            element.text = values[node.field]
+        for attribute, field_name in node.attributes:
+            if field_name in values:
+                element.set(attribute, values[field_name])
+        for child in node.children:
+            if not child.all_fields.isdisjoint(values):
+                self._build(element, child, values)
+        return element
+
+    def build(self, items, nsmap=None):
+        """Return a list with one group element per item dict.
+
+        None values are left out. nsmap should be the one of the target
+        document, so that new elements reuse its prefixes.
+        """
+        container = etree.Element('container', nsmap=nsmap)
+        for item in items:
+            self._build(container, self._plan, self._values(item))
+        return list(container)
+
+    def read(self, element):
+        """Return the field texts of one group element, the reverse of build().
+
+        Like XPath, each field takes its first match; missing ones are None.
+        """
+        values = dict.fromkeys(self.field_names)
+        self._read(element, self._plan, values)
+        return values
+
+    def _read(self, element, node, values):
+        if node.field is not None and values[node.field] is None:
+            values[node.field] = element.text
+        for attribute, field_name in node.attributes:
+            if values[field_name] is None:
+                values[field_name] = element.get(attribute)
+        for child in element:
+            child_node = node.by_tag.get(child.tag)
+            if child_node is not None:
+                self._read(child, child_node, values)
+
+    def insert(self, root, items, replace=False, level=None):
+        """Append one group per item to the XML tree root; return how many.
+
+        New groups go after the existing ones, or where the XSD expects
+        them when there are none. With replace=True, existing groups
+        are removed first. Raises ValueError when the XSD of level has
+        no such groups.
+        """
+        if level is not None and self.levels is not None and level not in self.levels:
+            raise ValueError('%s level %s has no %s' % (self.flavor, level, self.group))
+        parents = root.xpath(self.parent_path, namespaces=self._namespaces)
+        if not parents:
+            raise ValueError('%s has no %s element' % (self.flavor, self.parent_path))
+        parent = parents[0]
+        elements = self.build(items, root.nsmap)
+
+        if replace:
+            for existing in parent.findall(self.tag):
+                parent.remove(existing)
+        index = None
+        for i, child in enumerate(parent):
+            if child.tag == self.tag:
+                index = i + 1
+            elif child.tag in self.followed_by:
+                if index is None:
+                    index = i
+                break
+        if index is None:
+            index = len(parent)
+        parent[index:index] = elements
+        return len(elements)
+
+
+_BUILDERS = {}
+
+
+def get_builder(flavor, group):
+    """Return the shared GroupBuilder of group for flavor."""
+    key = (flavor, group)
+    builder = _BUILDERS.get(key)
+    if builder is None:
+        builder = _BUILDERS[key] = GroupBuilder(flavor, group)
+    return builder
@@ -0,0 +1,81 @@
+"""
+Indexes of the code lists used to validate invoice fields.
+
+Each code list is a frozenset built on first use by a loader function,
+so membership checks are constant time instead of scans over the source
+records. ISO 3166 countries and ISO 4217 currencies are registered from
+pycountry. Other lists (document types, units of measure...) can be added
+with register_code_list().
+"""
+
+import threading
+
+unicode = str
+
+
+class CodeList(object):
+    """A lazily loaded set of valid codes.
+
+    loader returns an iterable of codes. normalize, when given, is applied
+    to the loaded codes and to looked-up values, e.g. for case folding.
+    """
+
+    def __init__(self, name, loader, normalize=None):
+        self.name = name
+        self._loader = loader
+        self._normalize = normalize
+        self._codes = None
+        self._lock = threading.Lock()
+
+    @property
+    def codes(self):
+        if self._codes is None:
+            with self._lock:
+                if self._codes is None:
+                    codes = self._loader()
+                    if self._normalize is not None:
+                        codes = (self._normalize(code) for code in codes)
+                    self._codes = frozenset(codes)
+        return self._codes
+
+    def __contains__(self, value):
+        if not isinstance(value, unicode):
+            return False
+        if self._normalize is not None:
+            value = self._normalize(value)
+        return value in self.codes
+
+
+_CODE_LISTS = {}
+
+
+def register_code_list(name, loader, normalize=None):
+    """Register (or replace) the code list used for code_type name."""
+    _CODE_LISTS[name] = CodeList(name, loader, normalize)
+    return _CODE_LISTS[name]
+
+
+def get_code_list(name):
+    """Return the CodeList registered as name, or None."""
+    return _CODE_LISTS.get(name)
+
+
+def _pycountry_values(database_name):
+    # pycountry's lookup() matches any attribute of a record (codes,
+    # names...) case-insensitively, so all of them are indexed.
+    import pycountry
+
+    values = set()
+    for record in getattr(pycountry, database_name):
+        for value in record._fields.values():
+            if isinstance(value, unicode):
+                values.add(value)
+    return values
+
+
+def _lower(value):
+    return value.lower()
+
+
+register_code_list('country', lambda: _pycountry_values('countries'), _lower)
+register_code_list('currency', lambda: _pycountry_values('currencies'), _lower)
@@ -0,0 +1,105 @@
+"""
+Columnar extraction of repeated groups (line items, tax breakdown).
+
+Each field of a group in groups.yml is read for all groups of a document
+with one compiled XPath, returning a plain list of values in document
+order. Every step of the path is restricted to its first match, so a
+group contributes at most one value and a list as long as the number of
+groups is aligned with them. When some groups lack the field, that
+column alone is read group by group and holds None for the missing
+ones.
+
+Fields typed `decimal` in groups.yml come back as decimal.Decimal.
+"""
+
+from decimal import Decimal, InvalidOperation
+
+from lxml import etree
+
+from . import xml_flavor
+
+
+def _first_match_path(path):
+    steps = path.split('/')
+    leaf = steps.pop() if steps[-1].startswith('@') else None
+    steps = ['%s[1]' % step for step in steps]
+    steps.append(leaf or 'text()[1]')
+    return '/'.join(steps)
+
+
+def _to_decimals(values):
+    if None in values:
+        return [None if value is None else Decimal(value) for value in values]
+    return list(map(Decimal, values))
+
+
+def supports(flavor, group):
+    """Return whether groups.yml locates group in documents of flavor."""
+    return flavor in xml_flavor.GROUPS[group]['_path']
+
+
+class ColumnReader(object):
+    """Read the fields of one group of groups.yml as columns, for a flavor."""
+
+    def __init__(self, flavor, group):
+        if not supports(flavor, group):
+            raise ValueError('groups.yml has no %s path for %s' % (group, flavor))
+        definition = xml_flavor.GROUPS[group]
+        namespaces = xml_flavor.FLAVORS[flavor]['namespaces']
+        self.flavor = flavor
+        self.group = group
+        group_path = definition['_path'][flavor]
+        self._count = etree.XPath('count(%s)' % group_path, namespaces=namespaces)
+        self._groups = etree.XPath(group_path, namespaces=namespaces)
+
+        self.field_names = []
+        self.types = {}
+        self._document_xpaths = {}
+        self._group_xpaths = {}
+        for field_name, details in definition['_fields'].items():
+            if flavor not in details['_path']:
+                continue
+            self.field_names.append(field_name)
+            self.types[field_name] = details.get('_type', 'text')
+            path = _first_match_path(details['_path'][flavor])
+            self._document_xpaths[field_name] = etree.XPath(
+                '%s/%s' % (group_path, path), namespaces=namespaces, smart_strings=False)
+            self._group_xpaths[field_name] = etree.XPath(
+                path, namespaces=namespaces, smart_strings=False)
+
+    def read(self, xml, fields=None):
+        """Return {field name: list of values, one per group} for the XML tree xml.
+
+        fields restricts the columns read, all of them by default.
+        """
+        count = int(self._count(xml))
+        groups = None
+        columns = {}
+        for field_name in fields or self.field_names:
+            if field_name not in self._document_xpaths:
+                raise ValueError('Unknown %s field %r' % (self.group, field_name))
+            values = self._document_xpaths[field_name](xml)
+            if len(values) != count:
+                if groups is None:
+                    groups = self._groups(xml)
+                group_xpath = self._group_xpaths[field_name]
+                values = [(group_xpath(group) or [None])[0] for group in groups]
+            if self.types[field_name] == 'decimal':
+                try:
+                    values = _to_decimals(values)
+                except InvalidOperation:
+                    raise ValueError('%s field %r holds a value that is not a number' % (self.group, field_name))
+            columns[field_name] = values
+        return columns
+
+
+_READERS = {}
+
+
+def get_reader(flavor, group):
+    """Return the shared ColumnReader of group for flavor."""
+    key = (flavor, group)
+    reader = _READERS.get(key)
+    if reader is None:
+        reader = _READERS[key] = ColumnReader(flavor, group)
+    return reader
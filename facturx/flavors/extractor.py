@@ -0,0 +1,162 @@
+"""
+Single-pass extraction of the fields declared in fields.yml.
+
+All field paths of a flavor are merged into a trie keyed by element tag.
+Extraction does one C-level scan of the tree for the elements anchoring
+the `//`-prefixed paths, then follows the trie down through their
+children, so the whole document is traversed once instead of once per
+field.
+
+Paths using anything beyond plain `prefix:name` steps (predicates,
+attributes, wildcards...) are evaluated with their compiled XPath.
+"""
+
+import re
+
+from . import xml_flavor
+
+_STEP_RE = re.compile(r'^(?:([A-Za-z_][\w.-]*):)?([A-Za-z_][\w.-]*)$')
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'fields', 'all_fields')
+
+    def __init__(self):
+        self.children = {}
+        self.fields = []
+        self.all_fields = set()
+
+    def add(self, tags, field_name):
+        node = self
+        node.all_fields.add(field_name)
+        for tag in tags:
+            node = node.children.setdefault(tag, _TrieNode())
+            node.all_fields.add(field_name)
+        node.fields.append(field_name)
+
+
+def _split_path(path, namespaces):
+    """Turn an XPath location path into (is_absolute, [clark tags]).
+
+    Returns None when the path uses more than child steps on qualified
+    names and must be left to XPath.
+    """
+    if path.startswith('//'):
+        absolute, steps = False, path[2:].split('/')
+    elif path.startswith('/'):
+        absolute, steps = True, path[1:].split('/')
+    else:
+        return None
+    tags = []
+    for step in steps:
+        match = _STEP_RE.match(step)
+        if match is None:
+            return None
+        prefix, local_name = match.groups()
+        if prefix is None:
+            tags.append(local_name)
+        elif prefix in namespaces:
+            tags.append('{%s}%s' % (namespaces[prefix], local_name))
+        else:
+            return None
+    return absolute, tags
+
+
+class FieldExtractor(object):
+    """Extract every field of a flavor from an XML tree in one traversal.
+
+    The result is the same as evaluating each field path and taking the
+    text of the first match in document order.
+    """
+
+    def __init__(self, flavor):
+        self.flavor = flavor
+        namespaces = xml_flavor.FLAVORS[flavor].get('namespaces', {})
+        self.field_names = []
+        # Paths starting with '/' hang off the root element,
+        # paths starting with '//' off any element with the anchor tag.
+        self._absolute = _TrieNode()
+        self._anchors = {}
+        self._xpath_fields = []
+
+        for field_name, details in xml_flavor.FIELDS.items():
+            path = details['_path'].get(flavor)
+            if path is None:
+                continue
+            self.field_names.append(field_name)
+            split = _split_path(path, namespaces)
+            if split is None:
+                self._xpath_fields.append(field_name)
+                continue
+            absolute, tags = split
+            if absolute:
+                self._absolute.add(tags, field_name)
+            else:
+                anchor = self._anchors.setdefault(tags[0], _TrieNode())
+                anchor.add(tags[1:], field_name)
+        self._anchor_tags = tuple(self._anchors.keys())
+
+    def extract(self, xml):
+        """Return a dict mapping field names to text (None when absent)."""
+        # Like XPath, paths are resolved from the document, not from xml.
+        root = xml.getroottree().getroot()
+        found = {}
+        if self._absolute.children:
+            self._descend(_DocumentRoot(root), self._absolute, found)
+        if self._anchor_tags:
+            for anchor_el in root.iter(*self._anchor_tags):
+                if next(anchor_el.iterancestors(*self._anchor_tags), None) is not None:
+                    # Nested anchors could yield matches out of document
+                    # order; never seen in practice, so keep XPath semantics.
+                    return self._extract_with_xpath(xml)
+                node = self._anchors[anchor_el.tag]
+                self._collect(anchor_el, node, found)
+
+        for field_name in self._xpath_fields:
+            r = xml_flavor.get_xpath(self.flavor, field_name)(xml)
+            if r:
+                found[field_name] = r[0].text
+
+        return dict((field_name, found.get(field_name)) for field_name in self.field_names)
+
+    def _collect(self, element, node, found):
+        for field_name in node.fields:
+            if field_name not in found:
+                found[field_name] = element.text
+        if node.children:
+            self._descend(element, node, found)
+
+    def _descend(self, element, node, found):
+        if node.all_fields.issubset(found):
+            return
+        for child in element.iterchildren(*node.children.keys()):
+            self._collect(child, node.children[child.tag], found)
+
+    def _extract_with_xpath(self, xml):
+        output_dict = {}
+        for field_name in self.field_names:
+            r = xml_flavor.get_xpath(self.flavor, field_name)(xml)
+            output_dict[field_name] = r[0].text if r else None
+        return output_dict
+
+
+class _DocumentRoot(object):
+    """Stand-in for the document node, whose only child is the root element."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def iterchildren(self, *tags):
+        if self.root.tag in tags:
+            yield self.root
+
+
+_EXTRACTORS = {}
+
+
+def get_extractor(flavor):
+    """Return the (cached) FieldExtractor of a flavor."""
+    extractor = _EXTRACTORS.get(flavor)
+    if extractor is None:
+        extractor = _EXTRACTORS[flavor] = FieldExtractor(flavor)
+    return extractor
@@ -9,25 +9,87 @@ Data kept for each flavor:
 - xml templates to create new XML representations
 """
 
+import copy
+import hashlib
+import json
 import os
+import threading
+from collections.abc import Mapping
+from io import BytesIO
 from lxml import etree
 
-import pycountry
-import yaml
-
+from . import codes
+from .. import instrument, xmlparser
 from ..logger import logger
 
 unicode = str
 
 
 # Load information on different XML standards and paths from YML.
+# Parsing YAML is slow, so a JSON copy is cached in the user's cache
+# directory and used as long as the YAML file is unchanged. The package
+# directory itself may be read-only or shared between users.
+def _cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'factur-x')
+
+
 def _load_yml(filename):
-    with open(os.path.join(os.path.dirname(__file__), filename)) as f:
-        return yaml.load(f, Loader=yaml.FullLoader)
+    yml_path = os.path.join(os.path.dirname(__file__), filename)
+    # One cache file per installation, keyed on the YAML file location.
+    location = hashlib.sha1(os.path.abspath(yml_path).encode('utf-8')).hexdigest()[:16]
+    cache_path = os.path.join(_cache_dir(), '%s-%s.json' % (filename, location))
+    stat = os.stat(yml_path)
+    signature = [stat.st_mtime_ns, stat.st_size]
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached['signature'] == signature:
+            return cached['data']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    import yaml
+    with open(yml_path) as f:
+        data = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'signature': signature, 'data': data}, f)
+        os.replace(tmp_path, cache_path)
+    except (IOError, OSError, TypeError, ValueError):
+        logger.debug('Could not cache %s', filename)
+    return data
+
+
+class _LazyYml(Mapping):
+    """Read-only mapping loading a YML file of this package on first access."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = _load_yml(self._filename)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
 
+    def __len__(self):
+        return len(self.data)
 
-FIELDS = _load_yml('fields.yml')
-FLAVORS = _load_yml('flavors.yml')
+
+FIELDS = _LazyYml('fields.yml')
+FLAVORS = _LazyYml('flavors.yml')
+GROUPS = _LazyYml('groups.yml')
 
 
 class XMLFlavor(object):
@@ -46,22 +108,27 @@ class XMLFlavor(object):
         """Creates a new XML tree with the desired level and flavor from an existing template
 
         Returns lxml.etree and xml_flavor.XMLFlavor instance.
+
+        Each template is parsed once; callers get their own deep copy of it.
         """
-        template_filename = os.path.join(
-            os.path.dirname(__file__),
-            flavor,
-            'xml',
-            FLAVORS[flavor]['levels'][level]['xml'])
-        assert os.path.isfile(template_filename), 'Template for this flavor/level does not exist.'
-        parser = etree.XMLParser(remove_blank_text=True)
-        xml_tree = etree.parse(open(template_filename), parser).getroot()
-        return cls(xml_tree), xml_tree
+        key = (cls, flavor, level)
+        cached = _TEMPLATE_CACHE.get(key)
+        if cached is None:
+            template_filename = os.path.join(
+                os.path.dirname(__file__),
+                flavor,
+                'xml',
+                FLAVORS[flavor]['levels'][level]['xml'])
+            assert os.path.isfile(template_filename), 'Template for this flavor/level does not exist.'
+            template = xmlparser.parse(template_filename)
+            cached = _TEMPLATE_CACHE[key] = (cls(template), template)
+        template_flavor, template = cached
+        return copy.copy(template_flavor), copy.deepcopy(template)
 
     def get_level(self, facturx_xml_etree):
         if not isinstance(facturx_xml_etree, type(etree.Element('pouet'))):
             raise ValueError('facturx_xml_etree must be an etree.Element() object')
-        namespaces = facturx_xml_etree.nsmap
-        doc_id_xpath = facturx_xml_etree.xpath(self.get_xml_path('version'), namespaces=namespaces)
+        doc_id_xpath = self.get_xpath('version')(facturx_xml_etree)
         if not doc_id_xpath:
             raise ValueError("Version field not found.")
         doc_id = doc_id_xpath[0].text
@@ -77,34 +144,35 @@ class XMLFlavor(object):
     def check_xsd(self, etree_to_validate):
         """Validate the XML file against the XSD"""
 
-        xsd_filename = FLAVORS[self.name]['levels'][self.level]['schema']
-        xsd_file = os.path.join(
-            os.path.dirname(__file__),
-            self.name, 'xsd', xsd_filename)
-
-        xsd_etree_obj = etree.parse(open(xsd_file))
-        official_schema = etree.XMLSchema(xsd_etree_obj)
-        try:
-            official_schema.assertValid(etree_to_validate)
-        except Exception as e:
-            # if the validation of the XSD fails, we arrive here
-            logger.warning(
-                "The XML file is invalid against the XML Schema Definition")
-            logger.warning('XSD Error: %s', e)
-            raise Exception(
-                "The %s XML file is not valid against the official "
-                "XML Schema Definition. "
-                "Here is the error, which may give you an idea on the "
-                "cause of the problem: %s." % (self.name, unicode(e)))
+        official_schema, schema_lock = _get_schema(self.name, self.level)
+        # XMLSchema objects keep their error log on the instance, so
+        # validations sharing a compiled schema must not overlap.
+        with schema_lock, instrument.span('xsd.validate'):
+            try:
+                official_schema.assertValid(etree_to_validate)
+            except Exception as e:
+                # if the validation of the XSD fails, we arrive here
+                logger.warning(
+                    "The XML file is invalid against the XML Schema Definition")
+                logger.warning('XSD Error: %s', e)
+                raise Exception(
+                    "The %s XML file is not valid against the official "
+                    "XML Schema Definition. "
+                    "Here is the error, which may give you an idea on the "
+                    "cause of the problem: %s." % (self.name, unicode(e)))
         return True
 
     def get_xmp_xml(self):
-        xmp_file = os.path.join(
-            os.path.dirname(__file__),
-            self.name,
-            'xmp',
-            FLAVORS[self.name]['xmp_schema'])
-        return etree.parse(open(xmp_file))
+        xmp_data = _XMP_SCHEMAS.get(self.name)
+        if xmp_data is None:
+            xmp_file = os.path.join(
+                os.path.dirname(__file__),
+                self.name,
+                'xmp',
+                FLAVORS[self.name]['xmp_schema'])
+            with open(xmp_file, 'rb') as f:
+                xmp_data = _XMP_SCHEMAS[self.name] = f.read()
+        return etree.parse(BytesIO(xmp_data))
 
     def get_xml_path(self, field_name):
         """Return XML path based on field_name and flavor"""
@@ -116,15 +184,108 @@ class XMLFlavor(object):
         else:
             raise KeyError('Path not defined for currenct flavor.')
 
+    def get_xpath(self, field_name):
+        """Return the compiled etree.XPath for field_name in this flavor"""
+
+        return get_xpath(self.name, field_name)
+
     def valid_code(self, code_type, field_value):
-        try:
-            if code_type == 'country':
-                pycountry.countries.lookup(field_value)
-            elif code_type == 'currency':
-                pycountry.currencies.lookup(field_value)
+        """Check field_value against the code list registered for code_type"""
+
+        code_list = codes.get_code_list(code_type)
+        if code_list is None:
             return True
-        except LookupError:
-            return False
+        return field_value in code_list
+
+
+# Raw content of the XMP extension schema of each flavor
+_XMP_SCHEMAS = {}
+
+# Parsed templates, keyed by (XMLFlavor class, flavor, level). Values are
+# (XMLFlavor, root element) tuples, never handed out as they are.
+_TEMPLATE_CACHE = {}
+
+# Compiled XSD schemas, keyed by (flavor, level). Values are
+# (etree.XMLSchema, threading.Lock) tuples.
+_SCHEMA_CACHE = {}
+_SCHEMA_CACHE_LOCK = threading.Lock()
+
+
+def _compile_schema(flavor, level):
+    xsd_filename = FLAVORS[flavor]['levels'][level]['schema']
+    xsd_file = os.path.join(
+        os.path.dirname(__file__),
+        flavor, 'xsd', xsd_filename)
+    logger.debug('Compiling XSD %s for %s/%s', xsd_filename, flavor, level)
+    with instrument.span('xsd.compile'):
+        return etree.XMLSchema(etree.parse(xsd_file))
+
+
+def _get_schema(flavor, level):
+    key = (flavor, level)
+    entry = _SCHEMA_CACHE.get(key)
+    if entry is None:
+        with _SCHEMA_CACHE_LOCK:
+            entry = _SCHEMA_CACHE.get(key)
+            if entry is None:
+                entry = (_compile_schema(flavor, level), threading.Lock())
+                _SCHEMA_CACHE[key] = entry
+    return entry
+
+
+def warm_schema_cache(flavor=None, level=None):
+    """Compile and cache the XSD schemas ahead of the first validation.
+
+    Without arguments, every level of every flavor defining schemas is
+    compiled. Returns the list of (flavor, level) keys now in the cache.
+    """
+    flavors = [flavor] if flavor is not None else list(FLAVORS.keys())
+    warmed = []
+    for flavor_name in flavors:
+        levels = FLAVORS[flavor_name].get('levels', {})
+        for level_name in ([level] if level is not None else levels.keys()):
+            _get_schema(flavor_name, level_name)
+            warmed.append((flavor_name, level_name))
+    return warmed
+
+
+def clear_schema_cache(flavor=None, level=None):
+    """Drop compiled schemas so they get recompiled on next use.
+
+    Without arguments the whole cache is cleared, otherwise only the
+    entries matching the given flavor and/or level.
+    """
+    with _SCHEMA_CACHE_LOCK:
+        for key in list(_SCHEMA_CACHE.keys()):
+            if flavor is not None and key[0] != flavor:
+                continue
+            if level is not None and key[1] != level:
+                continue
+            del _SCHEMA_CACHE[key]
+
+
+# Compiled etree.XPath evaluators, keyed by (flavor, field_name).
+_XPATH_CACHE = {}
+
+
+def get_xpath(flavor, field_name):
+    """Return a compiled XPath for field_name, with the flavor namespaces bound.
+
+    Compiled evaluators are kept for the lifetime of the process; lxml
+    serializes concurrent calls on the same evaluator internally.
+    """
+    key = (flavor, field_name)
+    xpath = _XPATH_CACHE.get(key)
+    if xpath is None:
+        assert field_name in FIELDS.keys(), 'Field not specified. Try working directly on the XML tree.'
+        field_details = FIELDS[field_name]
+        if field_details['_path'].get(flavor) is None:
+            raise KeyError('Path not defined for currenct flavor.')
+        xpath = etree.XPath(
+            field_details['_path'][flavor],
+            namespaces=FLAVORS[flavor].get('namespaces', {}))
+        _XPATH_CACHE[key] = xpath
+    return xpath
 
 
 def valid_xmp_filenames():
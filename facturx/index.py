@@ -0,0 +1,334 @@
+"""
+Incremental sqlite index of the fields of many Factur-X invoices.
+
+Each indexed PDF becomes one row of the `invoices` table, with a column
+per field of fields.yml typed after its `_type`: dates are stored as ISO
+8601 text (YYYY-MM-DD), everything else as text. Decimals keep the exact
+text of the invoice and are compared as numbers with CAST(... AS REAL),
+which orders amounts of up to 15 significant digits exactly. Seller and
+buyer names, invoice number, date and total amount are indexed.
+
+Rows remember the size and modification time of their file, and
+optionally its SHA-256. Updating the index only re-reads files whose size
+or mtime changed; with use_hash=True a changed mtime costs a hash of the
+file, and the PDF is only parsed when its content differs. Fields are read
+with FacturX.peek(), without validation. Queries read the database only.
+
+    with InvoiceIndex('invoices.sqlite') as index:
+        index.update(batch.expand_paths(['archive/']), processes=8)
+        index.query(seller='Au bon moulin', date_from='2018-01-01')
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from decimal import Decimal, InvalidOperation
+
+from .flavors import xml_flavor
+from .logger import logger
+
+# Rows written per transaction while updating.
+COMMIT_EVERY = 1000
+
+# Databases of another version are dropped and rebuilt by the next update.
+SCHEMA_VERSION = 2
+
+_COLUMN_TYPES = {
+    'text': 'TEXT',
+    'date': 'TEXT',
+    'decimal': 'TEXT',
+}
+
+_INDEXED_FIELDS = ('seller_name', 'buyer_name', 'invoice_number', 'date', 'amount_total')
+
+# Compared case-insensitively by prefix, see InvoiceIndex.query().
+_NAME_FIELDS = ('seller_name', 'buyer_name')
+
+_FILE_COLUMNS = ('path', 'mtime_ns', 'size', 'sha256', 'flavor', 'level', 'error', 'indexed_at')
+
+
+def field_types():
+    """Return {field name: type} from the _type of fields.yml, text by default."""
+    return dict((name, details.get('_type', 'text')) for name, details in xml_flavor.FIELDS.items())
+
+
+def _to_date(text):
+    # Dates use format 102 of UN/CEFACT: YYYYMMDD. Queries may use ISO dates.
+    text = text.strip()
+    if len(text) == 10 and text[4] == text[7] == '-':
+        text = text.replace('-', '')
+    if len(text) != 8 or not text.isdigit():
+        return None
+    return '%s-%s-%s' % (text[:4], text[4:6], text[6:])
+
+
+def _to_decimal(text):
+    try:
+        return str(Decimal(text.strip()))
+    except InvalidOperation:
+        return None
+
+
+_CONVERTERS = {
+    'date': _to_date,
+    'decimal': _to_decimal,
+}
+
+
+def _hash_file(data):
+    digest = hashlib.sha256()
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def index_file(task):
+    """Read the fields of one PDF and return its index record.
+
+    task is (path, mtime_ns, size, known_sha256). known_sha256 is None
+    unless content hashes are used; when the file still has that hash the
+    record holds `unchanged` and the PDF is not parsed.
+    """
+    # Imported here so that pool workers started with 'spawn' pay for it once.
+    from .facturx import FacturX
+    from . import pdfreader
+
+    path, mtime_ns, size, known_sha256 = task
+    record = {'path': path, 'mtime_ns': mtime_ns, 'size': size, 'sha256': None}
+    try:
+        data = pdfreader.map_file(path)
+        try:
+            if known_sha256 is not None:
+                record['sha256'] = _hash_file(data)
+                if record['sha256'] == known_sha256:
+                    record['unchanged'] = True
+                    return record
+            result = FacturX.peek(data)
+        finally:
+            data.close()
+        if result is None:
+            record['error'] = 'No embedded Factur-X XML.'
+        else:
+            record.update(result)
+    except Exception as e:
+        logger.warning('Could not index %s: %s', path, e)
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    return record
+
+
+class InvoiceIndex(object):
+    """Index of invoice fields stored in the sqlite database at path."""
+
+    def __init__(self, path):
+        self.path = path
+        self.field_types = field_types()
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self._create_schema()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _column_definition(self, name):
+        definition = '%s %s' % (name, _COLUMN_TYPES[self.field_types[name]])
+        if name in _NAME_FIELDS:
+            definition += ' COLLATE NOCASE'
+        return definition
+
+    def _create_schema(self):
+        with self.connection:
+            version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS invoices')
+                self.connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS invoices ('
+                'path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, '
+                'sha256 TEXT, flavor TEXT, level TEXT, error TEXT, indexed_at REAL NOT NULL)')
+            # Fields added to fields.yml since the database was created
+            # get a column too; existing rows keep NULL until re-indexed.
+            existing = set(row[1] for row in self.connection.execute('PRAGMA table_info(invoices)'))
+            for name in sorted(self.field_types):
+                if name not in existing:
+                    self.connection.execute(
+                        'ALTER TABLE invoices ADD COLUMN %s' % self._column_definition(name))
+            for name in _INDEXED_FIELDS:
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS invoices_%s ON invoices (%s)' % (name, self._compared(name)))
+        self._columns = _FILE_COLUMNS + tuple(sorted(self.field_types))
+        self._insert = 'INSERT OR REPLACE INTO invoices (%s) VALUES (%s)' % (
+            ', '.join(self._columns), ', '.join('?' * len(self._columns)))
+
+    def _compared(self, name):
+        """Return the SQL expression comparing the column name by value."""
+        if self.field_types[name] == 'decimal':
+            return 'CAST(%s AS REAL)' % name
+        return name
+
+    def _query_value(self, name, value):
+        """Return value converted like the indexed values of the field name."""
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        converter = _CONVERTERS.get(self.field_types[name])
+        if converter is None:
+            return value
+        converted = converter(str(value))
+        if converted is None:
+            raise ValueError('Invalid %s value %r for %s.' % (self.field_types[name], value, name))
+        return converted
+
+    def _condition(self, name, operator):
+        if self.field_types[name] == 'decimal':
+            return '%s %s CAST(? AS REAL)' % (self._compared(name), operator)
+        return '%s %s ?' % (name, operator)
+
+    def _stale(self, paths, use_hash, stats):
+        """Yield the tasks of index_file() for paths missing or out of date."""
+        # A process pool pulls tasks from its own thread, so lookups use
+        # a connection of their own.
+        lookup = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        try:
+            for path in paths:
+                path = os.path.abspath(path)
+                try:
+                    stat = os.stat(path)
+                except OSError as e:
+                    logger.warning('Could not index %s: %s', path, e)
+                    stats['errors'] += 1
+                    continue
+                row = lookup.execute(
+                    'SELECT mtime_ns, size, sha256 FROM invoices WHERE path = ?', (path,)).fetchone()
+                if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+                    stats['unchanged'] += 1
+                    continue
+                known_sha256 = None
+                if use_hash:
+                    # An empty string never matches, but asks for the hash.
+                    known_sha256 = row[2] if row is not None and row[2] else ''
+                yield (path, stat.st_mtime_ns, stat.st_size, known_sha256)
+        finally:
+            lookup.close()
+
+    def _row(self, record):
+        values = {
+            'path': record['path'],
+            'mtime_ns': record['mtime_ns'],
+            'size': record['size'],
+            'sha256': record['sha256'],
+            'flavor': record.get('flavor'),
+            'level': record.get('level'),
+            'error': record.get('error'),
+            'indexed_at': time.time(),
+        }
+        for name, text in record.get('fields', {}).items():
+            if text is None or name not in self.field_types:
+                continue
+            converter = _CONVERTERS.get(self.field_types[name])
+            values[name] = converter(text) if converter else text
+        return tuple(values.get(column) for column in self._columns)
+
+    def update(self, paths, processes=1, use_hash=False):
+        """Index the PDFs at paths that are new or changed since the last update.
+
+        Files are read over a pool of processes (see batch.imap). With
+        use_hash, files whose mtime changed but whose SHA-256 did not are
+        not parsed again. Returns the counts of indexed, unchanged and
+        failed files; failures are indexed too, so that they are not
+        retried until the file changes.
+        """
+        from .batch import imap
+
+        stats = {'indexed': 0, 'unchanged': 0, 'errors': 0}
+        skipped = {'unchanged': 0, 'errors': 0}
+        records = []
+        for record in imap(index_file, self._stale(paths, use_hash, skipped), processes=processes):
+            if record.get('unchanged'):
+                stats['unchanged'] += 1
+            elif 'error' in record:
+                stats['errors'] += 1
+            else:
+                stats['indexed'] += 1
+            records.append(record)
+            if len(records) >= COMMIT_EVERY:
+                self._write(records)
+                records = []
+        self._write(records)
+        for key, value in skipped.items():
+            stats[key] += value
+        return stats
+
+    def _write(self, records):
+        with self.connection:
+            for record in records:
+                if record.get('unchanged'):
+                    self.connection.execute(
+                        'UPDATE invoices SET mtime_ns = ?, size = ? WHERE path = ?',
+                        (record['mtime_ns'], record['size'], record['path']))
+                else:
+                    self.connection.execute(self._insert, self._row(record))
+
+    def prune(self):
+        """Remove the rows of files that no longer exist; return their number."""
+        missing = [(path,) for (path,) in self.connection.execute('SELECT path FROM invoices')
+                   if not os.path.exists(path)]
+        with self.connection:
+            self.connection.executemany('DELETE FROM invoices WHERE path = ?', missing)
+        return len(missing)
+
+    def query(self, seller=None, buyer=None, number=None, date_from=None, date_to=None,
+              amount_min=None, amount_max=None, limit=None, **fields):
+        """Return the indexed invoices matching all the given criteria.
+
+        seller and buyer match the start of the name, ignoring case.
+        Dates are ISO strings or datetime.date, both bounds inclusive, and
+        amounts apply to amount_total. Other fields are matched exactly
+        by passing them by name, dates as YYYYMMDD or ISO and decimals by
+        value. Raises ValueError on values that do not convert to the type
+        of their field. Invoices that could not be read are left out.
+        Results are dicts shaped like the records of facturx.batch, with
+        dates in ISO format and decimals as their exact text.
+        """
+        conditions = ['error IS NULL']
+        params = []
+        for column, prefix in (('seller_name', seller), ('buyer_name', buyer)):
+            if prefix is not None:
+                conditions.append("%s LIKE ? ESCAPE '\\'" % column)
+                escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                params.append(escaped + '%')
+        if number is not None:
+            fields['invoice_number'] = number
+        for column, operator, value in (('date', '>=', date_from), ('date', '<=', date_to),
+                                        ('amount_total', '>=', amount_min),
+                                        ('amount_total', '<=', amount_max)):
+            if value is not None:
+                conditions.append(self._condition(column, operator))
+                params.append(self._query_value(column, value))
+        for name, value in sorted(fields.items()):
+            if name not in self.field_types:
+                raise ValueError('Unknown field %r.' % name)
+            conditions.append(self._condition(name, '='))
+            params.append(self._query_value(name, value))
+        sql = 'SELECT %s FROM invoices WHERE %s ORDER BY path' % (
+            ', '.join(self._columns), ' AND '.join(conditions))
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+
+        results = []
+        field_names = self._columns[len(_FILE_COLUMNS):]
+        for row in self.connection.execute(sql, params):
+            results.append({
+                'path': row[0],
+                'flavor': row[4],
+                'level': row[5],
+                'fields': dict(zip(field_names, row[len(_FILE_COLUMNS):])),
+            })
+        return results
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM invoices').fetchone()[0]
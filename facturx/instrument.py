@@ -0,0 +1,133 @@
+"""
+Opt-in instrumentation of the reading, validation and writing stages.
+
+The library wraps each stage in a named span and reports byte counters.
+Nothing is recorded until a tracer is installed with set_tracer(); until
+then span() hands out a shared no-op context manager and count() returns
+immediately.
+
+Span names:
+
+- pdf.read, pdf.parse, pdf.extract: loading the PDF, PyPDF2 parsing and
+  decoding of the embedded XML stream
+- xml.parse, xml.template, xml.serialize
+- xsd.compile, xsd.validate, validate (the whole is_valid() call)
+- fields.read, fields.write, fields.to_dict
+- xmp.build, pdf.write (the whole write_pdf() call), pdf.serialize
+
+Counters: bytes.read, bytes.written, validate.cache_hits.
+"""
+
+import threading
+import time
+
+
+class Tracer(object):
+    """Base class of tracers; override the hooks you need.
+
+    start() returns a token handed back to finish(), by default the
+    perf_counter() value at the start of the span.
+    """
+
+    def start(self, name):
+        return time.perf_counter()
+
+    def finish(self, name, token, error=None):
+        pass
+
+    def count(self, name, value):
+        pass
+
+
+class StatsTracer(Tracer):
+    """Tracer aggregating call counts and durations per span, and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+
+    def finish(self, name, token, error=None):
+        duration = time.perf_counter() - token
+        with self._lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = {'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+            stats['calls'] += 1
+            stats['total'] += duration
+            if duration > stats['max']:
+                stats['max'] = duration
+            if error is not None:
+                stats['errors'] += 1
+
+    def count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """Return a copy of the statistics as {'spans': ..., 'counters': ...}."""
+        with self._lock:
+            return {
+                'spans': dict((name, dict(stats)) for name, stats in self.spans.items()),
+                'counters': dict(self.counters),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+
+class _Span(object):
+    __slots__ = ('tracer', 'name', 'token')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.token = self.tracer.start(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.finish(self.name, self.token, exc_value)
+
+
+class _NoopSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Install tracer process-wide (None disables tracing); return the previous one."""
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name):
+    """Return a context manager timing the stage name."""
+    tracer = _tracer
+    if tracer is None:
+        return _NOOP_SPAN
+    return _Span(tracer, name)
+
+
+def count(name, value):
+    """Add value to the counter name."""
+    tracer = _tracer
+    if tracer is not None:
+        tracer.count(name, value)
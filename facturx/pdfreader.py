@@ -0,0 +1,232 @@
+"""
+Low-memory access to the XML embedded in a Factur-X PDF.
+
+The file is memory-mapped instead of being read into a BytesIO, so the
+kernel only pages in the parts PyPDF2 actually touches: the trailer, the
+cross-reference sections and the objects on the way from /Root to the
+embedded files name tree. Page content is never parsed and only the
+embedded XML stream is decoded.
+"""
+
+import mmap
+import zlib
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import IndirectObject
+
+from .flavors import xml_flavor
+from .logger import logger
+
+
+def map_file(path):
+    """Return a read-only, file-like memory map of the PDF at path."""
+    with open(path, 'rb') as f:
+        # The mapping stays valid after the file descriptor is closed.
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# Name trees deeper than this are treated as malformed (or cyclic).
+MAX_NAME_TREE_DEPTH = 32
+
+_accepted_filenames = None
+
+
+def accepted_filenames():
+    """Return the set of embedded file names of all flavors, built once."""
+    global _accepted_filenames
+    if _accepted_filenames is None:
+        _accepted_filenames = frozenset(xml_flavor.valid_xmp_filenames())
+    return _accepted_filenames
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return value
+
+
+def _name_tree_lookup(node, key):
+    """Return the value of key in a name tree, or None.
+
+    Follows /Kids by binary search on their /Limits, then bisects the
+    sorted /Names array of the leaf, so the cost is logarithmic in the
+    number of entries.
+    """
+    for _ in range(MAX_NAME_TREE_DEPTH):
+        node = node.getObject()
+        names = node.get('/Names')
+        if names is not None:
+            names = names.getObject()
+            low, high = 0, len(names) // 2
+            while low < high:
+                middle = (low + high) // 2
+                name = _text(names[2 * middle])
+                if name == key:
+                    return names[2 * middle + 1]
+                if name < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            return None
+        kids = node.get('/Kids')
+        if kids is None:
+            return None
+        kids = kids.getObject()
+        low, high = 0, len(kids)
+        node = None
+        while low < high:
+            middle = (low + high) // 2
+            limits = kids[middle].getObject().get('/Limits')
+            if limits is None:
+                return None
+            if key < _text(limits[0]):
+                high = middle
+            elif key > _text(limits[1]):
+                low = middle + 1
+            else:
+                node = kids[middle]
+                break
+        if node is None:
+            return None
+    return None
+
+
+def _iter_name_tree(node):
+    """Yield the (key, value) pairs of a name tree, in tree order."""
+    stack = [(node, 0)]
+    seen = set()
+    while stack:
+        node, depth = stack.pop()
+        if isinstance(node, IndirectObject):
+            if node.idnum in seen or depth > MAX_NAME_TREE_DEPTH:
+                continue
+            seen.add(node.idnum)
+        node = node.getObject()
+        names = node.get('/Names')
+        if names is not None:
+            names = names.getObject()
+            for i in range(0, len(names) - 1, 2):
+                yield _text(names[i]), names[i + 1]
+        kids = node.get('/Kids')
+        if kids is not None:
+            stack.extend((kid, depth + 1) for kid in reversed(kids.getObject()))
+
+
+def _embedded_stream(filespec, accepted=None):
+    """Return the embedded file stream of a file specification.
+
+    With accepted, only when the /UF or /F file name is one of them.
+    """
+    if filespec is None:
+        return None
+    filespec = filespec.getObject()
+    if not hasattr(filespec, 'get'):
+        return None
+    if accepted is not None and not any(
+            _text(filespec.get(key)) in accepted for key in ('/UF', '/F')):
+        return None
+    embedded = filespec.get('/EF')
+    if embedded is None:
+        return None
+    embedded = embedded.getObject()
+    stream = embedded.get('/F')
+    if stream is None:
+        stream = embedded.get('/UF')
+    return None if stream is None else stream.getObject()
+
+
+def get_embedded_file(pdf):
+    """Return the stream object of the Factur-X XML attached to a PdfFileReader.
+
+    The accepted file names are looked up as keys of the EmbeddedFiles
+    name tree, including trees split in /Kids. Failing that, the
+    associated files (/AF) of the catalog are checked, then every entry
+    of the name tree by its file name. Returns None when the PDF has no
+    matching embedded file.
+    """
+    pdf_root = pdf.trailer['/Root']
+    accepted = accepted_filenames()
+    tree = None
+    if '/Names' in pdf_root:
+        tree = pdf_root['/Names'].getObject().get('/EmbeddedFiles')
+    if tree is not None:
+        for filename in sorted(accepted):
+            stream = _embedded_stream(_name_tree_lookup(tree, filename))
+            if stream is not None:
+                return stream
+
+    associated_files = pdf_root.get('/AF')
+    if associated_files is not None:
+        for filespec in associated_files.getObject():
+            stream = _embedded_stream(filespec, accepted)
+            if stream is not None:
+                return stream
+
+    # Keys are usually the file names, but need not be.
+    if tree is not None:
+        for key, filespec in _iter_name_tree(tree):
+            stream = _embedded_stream(filespec, accepted)
+            if stream is not None:
+                return stream
+    return None
+
+
+def get_embedded_xml(pdf):
+    """Return the raw bytes of the Factur-X XML attached to a PdfFileReader.
+
+    Returns None when the PDF has no matching embedded file.
+    """
+    stream = get_embedded_file(pdf)
+    if stream is None:
+        return None
+    return stream.getData()
+
+
+def iter_stream_data(stream, chunk_size=65536):
+    """Yield the decoded data of a PDF stream object in chunks of at most chunk_size.
+
+    Unfiltered and plain /FlateDecode streams are inflated chunk by
+    chunk, so the decoded data is never held whole in memory (PyPDF2
+    still loads the encoded data). Other filters are decoded at once.
+    """
+    filters = stream.get('/Filter')
+    if isinstance(filters, list) and len(filters) == 1:
+        filters = filters[0]
+    data = getattr(stream, '_data', None)
+    if data is None or '/DecodeParms' in stream or filters not in (None, '/FlateDecode'):
+        data = stream.getData()
+        filters = None
+
+    if filters is None:
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+        return
+
+    decompressor = zlib.decompressobj()
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        while chunk:
+            output = decompressor.decompress(chunk, chunk_size)
+            if output:
+                yield output
+            chunk = decompressor.unconsumed_tail
+    output = decompressor.flush()
+    if output:
+        yield output
+
+
+def extract_xml(path):
+    """Return the embedded XML bytes of the PDF at path, or None.
+
+    Meant for large PDFs: the file is memory-mapped and only the
+    embedded-files branch of the document is resolved.
+    """
+    pdf_map = map_file(path)
+    try:
+        pdf = PdfFileReader(pdf_map)
+        xml_bytes = get_embedded_xml(pdf)
+        logger.debug('Extracted %s bytes of XML from %s',
+                     None if xml_bytes is None else len(xml_bytes), path)
+        return xml_bytes
+    finally:
+        pdf_map.close()
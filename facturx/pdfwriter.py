@@ -1,13 +1,17 @@
 import hashlib
 import io
 import mimetypes
+import re
+import shutil
+import zlib
 from datetime import datetime
 
-from PyPDF2 import PdfFileWriter, PdfFileReader
+from PyPDF2 import PdfFileWriter
 from PyPDF2.generic import DictionaryObject, DecodedStreamObject, \
-    NameObject, createStringObject, ArrayObject
+    NameObject, createStringObject, ArrayObject, IndirectObject, NumberObject
 from lxml import etree
 
+from . import instrument
 from .logger import logger
 
 # Python 2 and 3 compat
@@ -17,40 +21,13 @@ except NameError:
     file_types = (io.IOBase,)
 unicode = str
 
-class FacturXPDFWriter(PdfFileWriter):
-    def __init__(self, facturx, pdf_metadata=None):
-        """Take a FacturX instance and write the XML to the attached PDF file"""
 
-        super(FacturXPDFWriter, self).__init__()
-        # TODO: Can handle str/paths and ByteIO?
-        self.factx = facturx
-
-        original_pdf = PdfFileReader(facturx.pdf)
-        # Extract /OutputIntents obj from original invoice
-        output_intents = _get_original_output_intents(original_pdf)
-        self.appendPagesFromReader(original_pdf)
-
-        original_pdf_id = original_pdf.trailer.get('/ID')
-        logger.debug('original_pdf_id=%s', original_pdf_id)
-        if original_pdf_id:
-            self._ID = original_pdf_id
-            # else : generate some ?
-
-        if pdf_metadata is None:
-            base_info = {
-                'seller': self.factx['seller_name'],
-                'number': self.factx['invoice_number'],
-                'date': self.factx['date'],
-                'doc_type': self.factx['type'],
-                }
-            pdf_metadata = _base_info2pdf_metadata(base_info)
-        else:
-            # clean-up pdf_metadata dict
-            for key, value in pdf_metadata.iteritems():
-                if not isinstance(value, (str, unicode)):
-                    pdf_metadata[key] = ''
+class _FacturXAttachmentMixin(object):
+    """Catalog and attachment updates shared by the Factur-X writers.
 
-        self._update_metadata_add_attachment(pdf_metadata, output_intents)
+    Subclasses provide `factx`, `_root_object`, `_addObject()` and
+    `addMetadata()` the way PyPDF2's PdfFileWriter does.
+    """
 
     def _update_metadata_add_attachment(self, pdf_metadata, output_intents):
         '''This method is inspired from the code of the addAttachment()
@@ -58,15 +35,18 @@ class FacturXPDFWriter(PdfFileWriter):
         
         # The entry for the file
         facturx_xml_str = self.factx.xml_str
-        md5sum = hashlib.md5().hexdigest()
+        md5sum, size, stream_data = _digest_and_compress(
+            facturx_xml_str, getattr(self, '_compress_level', None))
         md5sum_obj = createStringObject(md5sum)
         params_dict = DictionaryObject({
             NameObject('/CheckSum'): md5sum_obj,
             NameObject('/ModDate'): createStringObject(_get_pdf_timestamp()),
-            NameObject('/Size'): NameObject(str(len(facturx_xml_str))),
+            NameObject('/Size'): NameObject(str(size)),
             })
         file_entry = DecodedStreamObject()
-        file_entry.setData(facturx_xml_str)  # here we integrate the file itself
+        file_entry.setData(stream_data)  # here we integrate the file itself
+        if stream_data is not facturx_xml_str:
+            file_entry[NameObject('/Filter')] = NameObject('/FlateDecode')
         file_entry.update({
             NameObject("/Type"): NameObject("/EmbeddedFile"),
             NameObject("/Params"): params_dict,
@@ -125,10 +105,10 @@ class FacturXPDFWriter(PdfFileWriter):
             output_intent_obj = self._addObject(output_intent_dict)
             res_output_intents.append(output_intent_obj)
         
-        # Update the root
-        xmp_level_str = self.factx.flavor.details['levels'][self.factx.flavor.level]['xmp_str']
-        xmp_template = self.factx.flavor.get_xmp_xml()
-        metadata_xml_str = _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, xmp_template, pdf_metadata)
+        # Update the root. PDF/A forbids filters on the metadata stream,
+        # so the XMP packet is never compressed.
+        with instrument.span('xmp.build'):
+            metadata_xml_str = _render_pdf_metadata_xml(self.factx.flavor, pdf_metadata)
         metadata_file_entry = DecodedStreamObject()
         metadata_file_entry.setData(metadata_xml_str)
         metadata_file_entry.update({
@@ -153,6 +133,245 @@ class FacturXPDFWriter(PdfFileWriter):
         self.addMetadata(metadata_txt_dict)
 
 
+class FacturXPDFWriter(_FacturXAttachmentMixin, PdfFileWriter):
+    def __init__(self, facturx, pdf_metadata=None, compress_level=None):
+        """Take a FacturX instance and write the XML to the attached PDF file
+
+        With a zlib compress_level (1-9), the embedded XML is stored
+        FlateDecode compressed.
+        """
+
+        super(FacturXPDFWriter, self).__init__()
+        # TODO: Can handle str/paths and ByteIO?
+        self.factx = facturx
+        self._compress_level = compress_level
+
+        original_pdf = facturx._take_pdf_reader()
+        # Extract /OutputIntents obj from original invoice
+        output_intents = _get_original_output_intents(original_pdf)
+        self.appendPagesFromReader(original_pdf)
+
+        original_pdf_id = original_pdf.trailer.get('/ID')
+        logger.debug('original_pdf_id=%s', original_pdf_id)
+        if original_pdf_id:
+            self._ID = original_pdf_id
+            # else : generate some ?
+
+        pdf_metadata = _get_pdf_metadata(self.factx, pdf_metadata)
+        self._update_metadata_add_attachment(pdf_metadata, output_intents)
+
+
+class FacturXIncrementalWriter(_FacturXAttachmentMixin):
+    """Write a Factur-X PDF as an incremental update of the original file.
+
+    The original bytes are copied unchanged and followed by the new
+    objects (embedded XML, filespec, XMP metadata, catalog and info
+    dictionaries), a cross-reference section covering only those objects
+    and a trailer pointing back to the original one with /Prev. The
+    /OutputIntents of the original catalog are kept as they are.
+    compress_level is the same as for FacturXPDFWriter.
+
+    The original document is only read, so a pdf_reader parsed from
+    facturx.pdf can be shared by any number of writers.
+    """
+
+    def __init__(self, facturx, pdf_metadata=None, compress_level=None, pdf_reader=None):
+        self.factx = facturx
+        self._compress_level = compress_level
+        original_pdf = pdf_reader if pdf_reader is not None else facturx._take_pdf_reader()
+        if original_pdf.isEncrypted:
+            raise ValueError('Incremental update of encrypted PDFs is not supported.')
+
+        self._source = facturx.pdf
+        self._source_length = _stream_length(self._source)
+        self._prev_startxref = _find_startxref(self._source, self._source_length)
+
+        trailer = original_pdf.trailer
+        self._trailer_id = trailer.get('/ID')
+        self._first_new_id = _next_object_number(original_pdf)
+        self._objects = []
+        # Catalog and info dictionary are rewritten under their own number.
+        self._root_ref = trailer.raw_get('/Root')
+        self._root_object = DictionaryObject(self._root_ref.getObject())
+        info_ref = trailer.raw_get('/Info') if '/Info' in trailer else None
+        if isinstance(info_ref, IndirectObject):
+            self._info_ref = info_ref
+            self._info = DictionaryObject(info_ref.getObject())
+        else:
+            self._info = DictionaryObject(info_ref or {})
+            self._info_ref = self._addObject(self._info)
+
+        pdf_metadata = _get_pdf_metadata(self.factx, pdf_metadata)
+        self._update_metadata_add_attachment(pdf_metadata, [])
+
+    def _addObject(self, obj):
+        self._objects.append(obj)
+        return IndirectObject(self._first_new_id + len(self._objects) - 1, 0, self)
+
+    def addMetadata(self, infos):
+        for key, value in infos.items():
+            self._info[NameObject(key)] = createStringObject(value)
+
+    def write(self, stream):
+        """Write the original document followed by the update to stream."""
+        _copy_source(self._source, stream)
+        self.write_update(stream)
+
+    def write_update(self, stream):
+        """Write only the incremental update section to stream.
+
+        stream must already hold the original document, unchanged.
+        """
+        buf = io.BytesIO()
+        # Make sure the first object starts on a new line.
+        buf.write(b'\n')
+        objects = [(self._root_ref.idnum, self._root_ref.generation, self._root_object),
+                   (self._info_ref.idnum, self._info_ref.generation, self._info)]
+        objects += [(self._first_new_id + i, 0, obj) for i, obj in enumerate(self._objects)
+                    if obj is not self._info]
+        objects.sort(key=lambda entry: entry[0])
+
+        offsets = []
+        for idnum, generation, obj in objects:
+            offsets.append(self._source_length + buf.tell())
+            buf.write(('%d %d obj\n' % (idnum, generation)).encode('ascii'))
+            obj.writeToStream(buf, None)
+            buf.write(b'\nendobj\n')
+
+        xref_location = self._source_length + buf.tell()
+        # The head of the free list first, as readers such as PyPDF2
+        # expect the first subsection to start at object 0.
+        buf.write(b'xref\n0 1\n0000000000 65535 f \n')
+        # Then one subsection per run of consecutive object numbers.
+        start = 0
+        while start < len(objects):
+            end = start + 1
+            while end < len(objects) and objects[end][0] == objects[end - 1][0] + 1:
+                end += 1
+            buf.write(('%d %d\n' % (objects[start][0], end - start)).encode('ascii'))
+            for i in range(start, end):
+                buf.write(('%010d %05d n \n' % (offsets[i], objects[i][1])).encode('ascii'))
+            start = end
+
+        trailer = DictionaryObject({
+            NameObject('/Size'): NumberObject(max(
+                self._first_new_id + len(self._objects), objects[-1][0] + 1)),
+            NameObject('/Root'): self._root_ref,
+            NameObject('/Info'): self._info_ref,
+            NameObject('/Prev'): NumberObject(self._prev_startxref),
+            })
+        if self._trailer_id:
+            trailer[NameObject('/ID')] = self._trailer_id
+        buf.write(b'trailer\n')
+        trailer.writeToStream(buf, None)
+        buf.write(('\nstartxref\n%d\n%%%%EOF\n' % xref_location).encode('ascii'))
+        stream.write(buf.getbuffer())
+        return buf.tell()
+
+    def append_to(self, path):
+        """Append the update in place to the unchanged original file at path.
+
+        Returns the number of bytes appended. Raises ValueError when the
+        size or the end of the file, which holds its startxref, differ
+        from the document that was loaded.
+        """
+        with open(path, 'r+b') as output_f:
+            if _stream_length(output_f) != self._source_length or (
+                    _read_tail(output_f, self._source_length) != _read_tail(self._source, self._source_length)):
+                raise ValueError('%s changed since it was loaded.' % path)
+            output_f.seek(0, 2)
+            with instrument.span('pdf.serialize'):
+                return self.write_update(output_f)
+
+
+def _digest_and_compress(data, compress_level=None, chunk_size=1 << 16):
+    """Return (MD5 hex digest, size, stream data) of the bytes data.
+
+    The stream data is data itself, or its zlib (FlateDecode) compressed
+    form when compress_level (1-9) is not None. Checksum and compression
+    are computed in one pass over the bytes.
+    """
+    if compress_level is not None and compress_level not in range(1, 10):
+        raise ValueError('compress_level must be from 1 to 9, not %r.' % (compress_level,))
+    md5 = hashlib.md5()
+    compressor = zlib.compressobj(compress_level) if compress_level is not None else None
+    chunks = []
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        chunk = view[start:start + chunk_size]
+        md5.update(chunk)
+        if compressor is not None:
+            chunks.append(compressor.compress(chunk))
+    if compressor is None:
+        return md5.hexdigest(), len(view), data
+    chunks.append(compressor.flush())
+    return md5.hexdigest(), len(view), b''.join(chunks)
+
+
+def _get_pdf_metadata(facturx, pdf_metadata):
+    if pdf_metadata is None:
+        base_info = {
+            'seller': facturx['seller_name'],
+            'number': facturx['invoice_number'],
+            'date': facturx['date'],
+            'doc_type': facturx['type'],
+            }
+        pdf_metadata = _base_info2pdf_metadata(base_info)
+    else:
+        # clean-up pdf_metadata dict
+        for key, value in pdf_metadata.items():
+            if not isinstance(value, (str, unicode)):
+                pdf_metadata[key] = ''
+    return pdf_metadata
+
+
+def _next_object_number(pdf):
+    # PyPDF2 does not keep /Size in the merged trailer; derive it from
+    # the cross-reference data it loaded.
+    idnums = list(pdf.xref_objStm.keys())
+    for generation_xref in pdf.xref.values():
+        idnums.extend(generation_xref.keys())
+    return max(idnums) + 1 if idnums else 1
+
+
+def _stream_length(stream):
+    stream.seek(0, 2)
+    return stream.tell()
+
+
+def _read_tail(stream, length, size=1024):
+    stream.seek(max(0, length - size))
+    return stream.read(size)
+
+
+def _find_startxref(stream, length):
+    """Return the offset of the last cross-reference section of a PDF."""
+    tail = _read_tail(stream, length)
+    position = tail.rfind(b'startxref')
+    if position < 0:
+        raise ValueError('startxref not found in the original PDF.')
+    return int(tail[position + len(b'startxref'):].split()[0])
+
+
+def _copy_source(source, output_f):
+    """Copy the original PDF to output_f.
+
+    The bytes come from the loaded document itself, never from the file
+    it was read from: offsets and /Prev were computed on those bytes,
+    and the file may have been rewritten since. Buffers and memory maps
+    are written straight from memory.
+    """
+    try:
+        view = source.getbuffer() if hasattr(source, 'getbuffer') else memoryview(source)
+    except TypeError:
+        source.seek(0)
+        shutil.copyfileobj(source, output_f)
+        return
+    # Release the view at once, a memory map cannot be closed while exported.
+    with view:
+        output_f.write(view)
+
+
 def _get_metadata_timestamp():
     now_dt = datetime.now()
     # example format : 2014-07-25T14:01:22+02:00
@@ -195,7 +414,8 @@ def _prepare_pdf_metadata_txt(pdf_metadata):
     return info_dict
 
 
-def _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, facturx_ext_schema_root, pdf_metadata):
+def _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, facturx_ext_schema_root, pdf_metadata,
+                              timestamp=None):
     nsmap_x = {'x': 'adobe:ns:meta/'}
     nsmap_rdf = {'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'}
     nsmap_dc = {'dc': 'http://purl.org/dc/elements/1.1/'}
@@ -254,7 +474,8 @@ def _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, facturx_ext_schema_ro
     creator = etree.SubElement(
         desc_xmp, ns_xmp + 'CreatorTool')
     creator.text = 'factur-x python lib'
-    timestamp = _get_metadata_timestamp()
+    if timestamp is None:
+        timestamp = _get_metadata_timestamp()
     etree.SubElement(desc_xmp, ns_xmp + 'CreateDate').text = timestamp
     etree.SubElement(desc_xmp, ns_xmp + 'ModifyDate').text = timestamp
 
@@ -284,6 +505,64 @@ def _prepare_pdf_metadata_xml(xmp_level_str, xmp_filename, facturx_ext_schema_ro
     return xml_final_str
 
 
+# Pre-serialized XMP packets per (flavor, level), see _get_xmp_template()
+_XMP_TEMPLATES = {}
+_XMP_SLOTS = ('title', 'author', 'subject', 'timestamp')
+_XMP_SLOT_RE = re.compile(b'@@facturx-xmp-(' + b'|'.join(s.encode('ascii') for s in _XMP_SLOTS) + b')@@')
+# Values lxml would refuse or serialize in another way go through the builder.
+_XMP_UNSAFE_RE = re.compile(u'[\x00-\x08\x0b-\x1f\ud800-\udfff\ufffe\uffff]')
+
+
+def _get_xmp_template(flavor):
+    """Return the XMP packet of a flavor/level split around its variable slots.
+
+    The packet is built once with _prepare_pdf_metadata_xml() using marker
+    values, and kept as (literal chunks, slot names) so that rendering is a
+    join of escaped values.
+    """
+    key = (flavor.name, flavor.level)
+    template = _XMP_TEMPLATES.get(key)
+    if template is None:
+        markers = dict((slot, '@@facturx-xmp-%s@@' % slot) for slot in _XMP_SLOTS)
+        xml_str = _prepare_pdf_metadata_xml(
+            flavor.details['levels'][flavor.level]['xmp_str'],
+            flavor.details['xmp_filename'],
+            flavor.get_xmp_xml(),
+            markers,
+            timestamp=markers['timestamp'])
+        parts = _XMP_SLOT_RE.split(xml_str)
+        template = (parts[0::2], [part.decode('ascii') for part in parts[1::2]])
+        _XMP_TEMPLATES[key] = template
+    return template
+
+
+def _render_pdf_metadata_xml(flavor, pdf_metadata):
+    """Return the same bytes as _prepare_pdf_metadata_xml() from the cached template."""
+    values = dict((slot, pdf_metadata.get(slot, '')) for slot in ('title', 'author', 'subject'))
+    values['timestamp'] = _get_metadata_timestamp()
+    for value in values.values():
+        if not isinstance(value, unicode) or _XMP_UNSAFE_RE.search(value):
+            return _prepare_pdf_metadata_xml(
+                flavor.details['levels'][flavor.level]['xmp_str'],
+                flavor.details['xmp_filename'],
+                flavor.get_xmp_xml(),
+                pdf_metadata,
+                timestamp=values['timestamp'])
+
+    literals, slots = _get_xmp_template(flavor)
+    chunks = [literals[0]]
+    for slot, literal in zip(slots, literals[1:]):
+        chunks.append(_escape_xml_text(values[slot]))
+        chunks.append(literal)
+    return b''.join(chunks)
+
+
+def _escape_xml_text(value):
+    # Same escaping as libxml2 applies to text nodes
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '>', '&gt;').encode('utf-8')
+
+
 # def createByteObject(string):
 #    string_to_encode = u'\ufeff' + string
 #    x = string_to_encode.encode('utf-16be')
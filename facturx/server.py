@@ -0,0 +1,240 @@
+"""
+Long-running daemon answering validate, dump and embed requests.
+
+A one-shot `facturx validate` pays for interpreter start-up, loading
+the field and flavor maps and compiling the XSD schemas before looking at
+the invoice. `facturx serve` does all of that once per worker process and
+then answers requests over a local Unix socket, so a client only pays for
+the work on the invoice itself.
+
+The protocol is JSON Lines: each request is one JSON object on one line
+and gets exactly one response line, in order, on the same connection.
+
+    {"op": "validate", "path": "/abs/invoice.pdf"}
+    {"op": "dump", "path": "/abs/invoice.pdf"}
+    {"op": "dump", "path": "/abs/invoice.pdf", "output": "/abs/metadata.json"}
+    {"op": "embed", "path": "/abs/no-xml.pdf", "xml": "/abs/metadata.xml",
+     "output": "/abs/invoice.pdf", "compress_level": 6}
+
+Responses hold "ok" and either "result" or "error". An "id" given in the
+request is echoed back. Paths are resolved by the server, so clients
+should send absolute ones.
+"""
+
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import tempfile
+
+from .logger import logger
+
+
+def _default_socket():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'facturx.sock')
+    # A directory of its own in the shared temporary directory, that
+    # only the user can enter, see _prepare_socket_dir().
+    return os.path.join(tempfile.gettempdir(), 'facturx-%d' % os.getuid(), 'facturx.sock')
+
+
+DEFAULT_SOCKET = _default_socket()
+
+OPERATIONS = ('validate', 'dump', 'embed')
+
+
+def warm_up():
+    """Load everything a request needs; run once in every worker."""
+    from . import pdfreader, pdfwriter
+    from .flavors import extractor, xml_flavor
+    for flavor in xml_flavor.FLAVORS:
+        extractor.get_extractor(flavor)
+    xml_flavor.FIELDS.keys()
+    xml_flavor.warm_schema_cache()
+
+
+def _dump(factx, output=None):
+    if output is None:
+        return factx.to_dict()
+    output_format = os.path.splitext(output)[1].lstrip('.')
+    if output_format == 'json':
+        factx.write_json(output)
+    elif output_format == 'xml':
+        factx.write_xml(output)
+    elif output_format == 'yml':
+        factx.write_yaml(output)
+    else:
+        raise ValueError('Unsupported output format: %r' % output_format)
+    return output
+
+
+def handle_request(request):
+    """Execute one request dict and return its response dict."""
+    from .facturx import FacturX
+
+    response = {}
+    if 'id' in request:
+        response['id'] = request['id']
+    try:
+        op = request.get('op')
+        if op not in OPERATIONS:
+            raise ValueError('Unknown operation: %r' % op)
+        factx = FacturX(request['path'])
+        if op == 'validate':
+            result = {'valid': factx.is_valid()}
+        elif op == 'dump':
+            result = _dump(factx, request.get('output'))
+        else:
+            factx.read_xml(request['xml'])
+            factx.write_pdf(request['output'], incremental=request.get('incremental', False),
+                            compress_level=request.get('compress_level'))
+            result = request['output']
+        response.update(ok=True, result=result)
+    except Exception as e:
+        logger.warning('Request %r failed: %s', request, e)
+        response.update(ok=False, error='%s: %s' % (type(e).__name__, e))
+    return response
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('A request must be a JSON object.')
+            except ValueError as e:
+                response = {'ok': False, 'error': 'Invalid request: %s' % e}
+            else:
+                response = self.server.pool.apply(handle_request, (request,))
+            self.wfile.write(json.dumps(response, sort_keys=True).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class FacturXServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server dispatching requests to a pool of warm workers.
+
+    Each connection is served by a thread that waits for a worker
+    process, so CPU-bound requests run in parallel up to the pool size.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, processes=None):
+        import multiprocessing
+        _prepare_socket_dir(os.path.dirname(os.path.abspath(socket_path)))
+        _remove_stale_socket(socket_path)
+        self.pool = multiprocessing.Pool(processes, initializer=warm_up)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+        except Exception:
+            self.pool.terminate()
+            raise
+        self.socket_path = socket_path
+
+    def server_bind(self):
+        # The socket file is created by bind(): with this umask it is
+        # never reachable by other users, not even until a chmod.
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def _prepare_socket_dir(directory):
+    """Create the per-user directory of DEFAULT_SOCKET, and check it is private."""
+    if directory != os.path.dirname(_default_socket()) or os.environ.get('XDG_RUNTIME_DIR'):
+        return
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise ValueError('%s must be a directory only accessible by its owner.' % directory)
+
+
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        raise ValueError('%s exists and is not a socket.' % socket_path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except socket.error:
+        # Left behind by a server that did not shut down cleanly
+        os.remove(socket_path)
+    else:
+        raise ValueError('A server is already listening on %s.' % socket_path)
+    finally:
+        probe.close()
+
+
+def serve(socket_path=DEFAULT_SOCKET, processes=None):
+    """Serve requests on socket_path until interrupted."""
+    server = FacturXServer(socket_path, processes)
+    # Installed after the pool has forked, which keeps the default
+    # handler in the workers.
+    signal.signal(signal.SIGTERM, _terminate)
+    logger.info('Listening on %s', socket_path)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+
+
+def _terminate(signum, frame):
+    raise SystemExit()
+
+
+class Client(object):
+    """Connection to a running server; send requests with call().
+
+    Usable as a context manager. One connection serves any number of
+    requests, one at a time.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile('rwb')
+
+    def call(self, op, path, **params):
+        """Send one request and return the response dict."""
+        params.update(op=op, path=os.path.abspath(path))
+        for key in ('xml', 'output'):
+            if params.get(key) is not None:
+                params[key] = os.path.abspath(params[key])
+        self._file.write(json.dumps(params).encode('utf-8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('The server closed the connection.')
+        return json.loads(line.decode('utf-8'))
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,118 @@
+"""
+Streaming reader for invoices too large to hold as one XML tree.
+
+The embedded XML stream is inflated chunk by chunk and fed to a pull
+parser. Each line item is read as soon as it is complete, with the
+group tree of flavors/builder.py, then cleared and dropped, so memory
+stays flat whatever the number of lines. The rest of the document is
+kept; it is small, and the header fields are read from it with the
+trie of flavors/extractor.py.
+
+In CII the document number, type, date and notes come before the line
+items, but the trade agreement (seller, buyer), delivery and settlement
+(amounts, VAT) come after them. Events are therefore yielded as:
+
+- ('header', {'flavor', 'level', 'fields'}) with the fields outside the
+  trade transaction, before the first line item
+- ('line_item', fields) for each line, with the line_items fields of
+  groups.yml as text
+- ('trade', fields) with the remaining fields of fields.yml, at the end
+
+    for kind, data in FacturX.stream('huge.pdf'):
+        ...
+"""
+
+from . import pdfreader, xmlparser
+from .flavors import builder, columns, extractor, xml_flavor
+
+
+def _line_builders():
+    builders = {}
+    for flavor in xml_flavor.FLAVORS:
+        if columns.supports(flavor, 'line_items'):
+            line_builder = builder.get_builder(flavor, 'line_items')
+            builders[line_builder.tag] = line_builder
+    return builders
+
+
+def _trade_fields(flavor):
+    """Return the fields of flavor located in the parent of the line items."""
+    if not columns.supports(flavor, 'line_items'):
+        return frozenset()
+    parent_step = builder.get_builder(flavor, 'line_items').parent_path.rsplit('/', 1)[-1]
+    return frozenset(
+        field_name for field_name, details in xml_flavor.FIELDS.items()
+        if parent_step in details['_path'].get(flavor, '').split('/'))
+
+
+class _Document(object):
+    """Header and trade fields of the partially parsed document."""
+
+    def __init__(self, root):
+        self.flavor = xml_flavor.XMLFlavor(root)
+        self.root = root
+        self.trade_fields = _trade_fields(self.flavor.name)
+
+    def fields(self, trade):
+        values = extractor.get_extractor(self.flavor.name).extract(self.root)
+        return dict((field_name, value) for field_name, value in values.items()
+                    if (field_name in self.trade_fields) == trade)
+
+    def header(self):
+        return {'flavor': self.flavor.name, 'level': self.flavor.level, 'fields': self.fields(False)}
+
+
+def iter_xml(chunks):
+    """Yield the header, line item and trade events of the XML data in chunks.
+
+    chunks is an iterable of bytes, see the module docstring for the events.
+    """
+    builders = _line_builders()
+    parser = xmlparser.pull_parser(('start', 'end'), tag=tuple(builders))
+    state = {}
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event in _read_events(parser, builders, state):
+            yield event
+    root = parser.close()
+    for event in _read_events(parser, builders, state):
+        yield event
+
+    document = state.get('document')
+    if document is None:
+        document = _Document(root)
+        yield 'header', document.header()
+    yield 'trade', document.fields(True)
+
+
+def _read_events(parser, builders, state):
+    for event, element in parser.read_events():
+        if event == 'start':
+            if 'document' not in state:
+                document = state['document'] = _Document(element.getroottree().getroot())
+                yield 'header', document.header()
+            continue
+        yield 'line_item', builders[element.tag].read(element)
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def iter_invoice(pdf_invoice, chunk_size=65536):
+    """Yield the events of the XML embedded in pdf_invoice, a path or a file object.
+
+    Raises ValueError when the PDF holds no Factur-X XML.
+    """
+    pdf_map = None
+    if isinstance(pdf_invoice, str):
+        pdf_invoice = pdf_map = pdfreader.map_file(pdf_invoice)
+    try:
+        pdf = pdfreader.PdfFileReader(pdf_invoice)
+        stream = pdfreader.get_embedded_file(pdf)
+        if stream is None:
+            raise ValueError('No embedded Factur-X XML found.')
+        for event in iter_xml(pdfreader.iter_stream_data(stream, chunk_size)):
+            yield event
+    finally:
+        if pdf_map is not None:
+            pdf_map.close()
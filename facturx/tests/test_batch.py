@@ -0,0 +1,50 @@
+import io
+import json
+import os
+import unittest
+from facturx import batch
+from facturx.facturx import *
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+
+    def test_expand_paths(self):
+        paths = list(batch.expand_paths([self.test_files_dir]))
+        self.assertEqual(len(paths), len(os.listdir(self.test_files_dir)))
+        pattern = os.path.join(self.test_files_dir, 'Facture_FR_*.pdf')
+        self.assertEqual(len(list(batch.expand_paths([pattern]))), 4)
+
+    def test_expand_paths_matches_extension_case(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp(prefix='facturx-test-')
+        try:
+            for name in ('a.pdf', 'b.PDF'):
+                open(os.path.join(directory, name), 'wb').close()
+            self.assertEqual(list(batch.expand_paths([directory])), [os.path.join(directory, 'a.pdf')])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_batch_results_in_order(self):
+        paths = sorted(batch.expand_paths([os.path.join(self.test_files_dir, 'Facture_*.pdf')]))
+        paths.insert(2, 'missing.pdf')
+        results = list(FacturX.batch(paths, processes=2))
+        self.assertEqual([result['path'] for result in results], paths)
+        self.assertIn('error', results[2])
+        self.assertEqual(results[0]['fields'], FacturX(paths[0]).to_dict())
+        self.assertIn('valid', results[0])
+
+    def test_write_jsonl(self):
+        output = io.StringIO()
+        results = batch.iter_batch(['missing.pdf', os.path.join(self.test_files_dir, 'embedded_data.pdf')],
+                                   processes=1, validate=False)
+        self.assertEqual(batch.write_jsonl(results, output), 1)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(len(lines), 2)
+        self.assertNotIn('valid', lines[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from facturx import bulk
+from facturx.facturx import *
+
+
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.base_pdf = os.path.join(self.test_files_dir, 'no_embedded_data.pdf')
+        self.work_dir = tempfile.mkdtemp(prefix='facturx-test-')
+        factx = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+        invoice_number = factx.flavor.get_xpath('invoice_number')(factx.xml)[0]
+        self.payloads = []
+        for i in range(3):
+            invoice_number.text = 'BULK-%d' % i
+            self.payloads.append(('bulk-%d.pdf' % i, factx.xml_str))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def check_pdf(self, data, i):
+        with open(self.base_pdf, 'rb') as f:
+            self.assertTrue(data.startswith(f.read()))
+        self.assertEqual(FacturX(io.BytesIO(data))['invoice_number'], 'BULK-%d' % i)
+
+    def test_directory(self):
+        output = os.path.join(self.work_dir, 'out')
+        payloads = self.payloads + [('broken.pdf', b'<invoice/>')]
+        results = list(bulk.generate(self.base_pdf, payloads, output))
+        self.assertEqual([result['name'] for result in results], [name for name, xml in payloads])
+        self.assertIn('error', results[-1])
+        self.assertEqual(sorted(os.listdir(output)), ['bulk-0.pdf', 'bulk-1.pdf', 'bulk-2.pdf'])
+        for i in range(3):
+            with open(results[i]['output'], 'rb') as f:
+                self.check_pdf(f.read(), i)
+
+    def test_archives(self):
+        zip_path = os.path.join(self.work_dir, 'out.zip')
+        list(bulk.generate(self.base_pdf, self.payloads, zip_path, compress_level=6))
+        with zipfile.ZipFile(zip_path) as archive:
+            for i in range(3):
+                self.check_pdf(archive.read('bulk-%d.pdf' % i), i)
+
+        tar_path = os.path.join(self.work_dir, 'out.tar.gz')
+        list(bulk.generate(self.base_pdf, self.payloads, tar_path))
+        with tarfile.open(tar_path) as archive:
+            for i in range(3):
+                self.check_pdf(archive.extractfile('bulk-%d.pdf' % i).read(), i)
+
+    def test_names_from_paths(self):
+        xml_path = os.path.join(self.work_dir, 'invoice-42.xml')
+        with open(xml_path, 'wb') as f:
+            f.write(self.payloads[0][1])
+        results = list(bulk.generate(self.base_pdf, [xml_path, self.payloads[1][1]],
+                                     os.path.join(self.work_dir, 'out')))
+        self.assertEqual([result['name'] for result in results], ['invoice-42.pdf', 'invoice-000002.pdf'])
+
+    def test_same_names_do_not_collide(self):
+        xml_paths = []
+        for i in range(2):
+            directory = os.path.join(self.work_dir, 'supplier-%d' % i)
+            os.makedirs(directory)
+            xml_paths.append(os.path.join(directory, 'invoice.xml'))
+            with open(xml_paths[-1], 'wb') as f:
+                f.write(self.payloads[i][1])
+        zip_path = os.path.join(self.work_dir, 'out.zip')
+        results = list(bulk.generate(self.base_pdf, xml_paths, zip_path))
+        self.assertEqual([result['name'] for result in results], ['invoice.pdf', 'invoice-2.pdf'])
+        with zipfile.ZipFile(zip_path) as archive:
+            self.assertEqual(archive.namelist(), ['invoice.pdf', 'invoice-2.pdf'])
+            for i, name in enumerate(archive.namelist()):
+                self.check_pdf(archive.read(name), i)
+
+    def test_failed_open_keeps_error(self):
+        sink = bulk.DirectorySink(os.path.join(self.work_dir, 'out'))
+        with self.assertRaises(FileNotFoundError) as raised:
+            sink.add('missing/invoice.pdf', None)
+        # The error of open(), not one raised while cleaning up after it
+        self.assertIsNone(raised.exception.__context__)
+
+
+if __name__ == '__main__':
+    unittest.main()
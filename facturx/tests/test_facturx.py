@@ -1,7 +1,18 @@
+import asyncio
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
+from decimal import Decimal
+from unittest import mock
 from facturx.facturx import *
+from facturx import instrument, pdfreader, pdfwriter
+from facturx.flavors import xml_flavor
 from lxml import etree
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, NameObject,
+                            createStringObject)
 
 
 class TestReading(unittest.TestCase):
@@ -71,6 +82,793 @@ class TestReading(unittest.TestCase):
         os.remove(test_file_path)
 
 
+class TestSchemaCache(unittest.TestCase):
+    def setUp(self):
+        xml_flavor.clear_schema_cache()
+        self.file_path = os.path.join(os.path.dirname(__file__), 'sample_invoices', 'embedded_data.pdf')
+
+    def test_schema_compiled_once(self):
+        factx = FacturX(self.file_path)
+        schema = xml_flavor._get_schema(factx.flavor.name, factx.flavor.level)
+        factx.is_valid()
+        self.assertIs(xml_flavor._get_schema(factx.flavor.name, factx.flavor.level), schema)
+
+    def test_warm_and_clear(self):
+        warmed = xml_flavor.warm_schema_cache('factur-x')
+        self.assertIn(('factur-x', 'en16931'), warmed)
+        self.assertIn(('factur-x', 'en16931'), xml_flavor._SCHEMA_CACHE)
+        xml_flavor.clear_schema_cache(level='en16931')
+        self.assertNotIn(('factur-x', 'en16931'), xml_flavor._SCHEMA_CACHE)
+        self.assertIn(('factur-x', 'minimum'), xml_flavor._SCHEMA_CACHE)
+
+    def test_concurrent_validation(self):
+        factx = FacturX(self.file_path)
+        xml_flavor.clear_schema_cache()
+        results = []
+
+        def validate():
+            results.append(factx.flavor.check_xsd(factx.xml))
+
+        threads = [threading.Thread(target=validate) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 8)
+        self.assertEqual(len(xml_flavor._SCHEMA_CACHE), 1)
+
+
+class TestXPathRegistry(unittest.TestCase):
+    def test_registry_reuses_compiled_xpath(self):
+        xpath = xml_flavor.get_xpath('factur-x', 'invoice_number')
+        self.assertIsInstance(xpath, etree.XPath)
+        self.assertIs(xml_flavor.get_xpath('factur-x', 'invoice_number'), xpath)
+
+    def test_field_access_matches_raw_xpath(self):
+        file_path = os.path.join(os.path.dirname(__file__), 'sample_invoices', 'Facture_FR_EN16931.pdf')
+        factx = FacturX(file_path)
+        for field, details in xml_flavor.FIELDS.items():
+            raw = factx.xml.xpath(details['_path']['factur-x'], namespaces=factx.xml.nsmap)
+            self.assertEqual(factx.flavor.get_xpath(field)(factx.xml), raw)
+        self.assertEqual(factx['invoice_number'], 'FA-2017-0010')
+
+
+class TestToDict(unittest.TestCase):
+    def test_to_dict_matches_per_field_xpath(self):
+        sample_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        for file_name in sorted(os.listdir(sample_dir)):
+            factx = FacturX(os.path.join(sample_dir, file_name))
+            expected = {}
+            for field, details in xml_flavor.FIELDS.items():
+                r = factx.xml.xpath(details['_path']['factur-x'], namespaces=factx.xml.nsmap)
+                expected[field] = r[0].text if r else None
+            self.assertEqual(factx.to_dict(), expected, file_name)
+
+
+class TestMmapExtraction(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+
+    def test_mmap_matches_in_memory(self):
+        file_path = os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')
+        factx = FacturX(file_path)
+        mapped = FacturX(file_path, use_mmap=True)
+        self.assertEqual(mapped.xml_str, factx.xml_str)
+        xml = etree.fromstring(pdfreader.extract_xml(file_path))
+        self.assertEqual(etree.tostring(xml, pretty_print=True), factx.xml_str)
+
+    def test_extract_xml_without_embedded_data(self):
+        file_path = os.path.join(self.test_files_dir, 'no_embedded_data.pdf')
+        self.assertIsNone(pdfreader.extract_xml(file_path))
+
+    def test_write_pdf_from_mmap(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'), use_mmap=True)
+        test_file_path = os.path.join(self.test_files_dir, 'test_mmap.pdf')
+        try:
+            factx.write_pdf(test_file_path)
+            self.assertEqual(FacturX(test_file_path).xml_str, factx.xml_str)
+        finally:
+            os.remove(test_file_path)
+
+    def test_write_pdf_over_mapped_source(self):
+        import shutil
+        test_file_path = os.path.join(self.test_files_dir, 'test_mmap_overwrite.pdf')
+        shutil.copy(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'), test_file_path)
+        try:
+            with FacturX(test_file_path, use_mmap=True) as factx:
+                factx['invoice_number'] = 'MMAP-0001'
+                factx.write_pdf(test_file_path)
+            written = FacturX(test_file_path)
+            self.assertEqual(written['invoice_number'], 'MMAP-0001')
+            self.assertEqual(written.xml_str, factx.xml_str)
+            self.assertEqual(os.listdir(self.test_files_dir).count('test_mmap_overwrite.pdf'), 1)
+            self.assertFalse([name for name in os.listdir(self.test_files_dir) if name.endswith('.tmp')])
+        finally:
+            os.remove(test_file_path)
+
+
+class TestWriterReuse(unittest.TestCase):
+    def test_writer_reuses_parsed_reader(self):
+        test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        factx = FacturX(os.path.join(test_files_dir, 'Facture_FR_BASIC.pdf'))
+        reader = factx._pdf_reader
+        self.assertIs(factx._take_pdf_reader(), reader)
+        self.assertIsNot(factx._take_pdf_reader(), reader)
+
+        # Writing several times parses the source again once the reader was used
+        for i in range(2):
+            test_file_path = os.path.join(test_files_dir, 'test_reuse.pdf')
+            try:
+                factx.write_pdf(test_file_path)
+                self.assertEqual(FacturX(test_file_path).xml_str, factx.xml_str)
+            finally:
+                os.remove(test_file_path)
+
+
+class TestIncrementalWrite(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.source_path = os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')
+        self.test_file_path = os.path.join(self.test_files_dir, 'test_incremental.pdf')
+
+    def tearDown(self):
+        if os.path.exists(self.test_file_path):
+            os.remove(self.test_file_path)
+
+    def test_original_bytes_are_kept(self):
+        for use_mmap in (False, True):
+            factx = FacturX(self.source_path, use_mmap=use_mmap)
+            factx['invoice_number'] = 'INC-0001'
+            factx.write_pdf(self.test_file_path, incremental=True)
+            with open(self.source_path, 'rb') as f:
+                original = f.read()
+            with open(self.test_file_path, 'rb') as f:
+                updated = f.read()
+            self.assertTrue(updated.startswith(original))
+            self.assertLess(len(updated) - len(original), len(original))
+
+            written = FacturX(self.test_file_path)
+            self.assertEqual(written['invoice_number'], 'INC-0001')
+            self.assertEqual(written.xml_str, factx.xml_str)
+
+    def test_append_in_place(self):
+        with open(self.source_path, 'rb') as source, open(self.test_file_path, 'wb') as target:
+            target.write(source.read())
+        factx = FacturX(self.test_file_path)
+        factx['invoice_number'] = 'INC-0002'
+        factx.write_pdf(self.test_file_path, incremental=True)
+        self.assertEqual(FacturX(self.test_file_path)['invoice_number'], 'INC-0002')
+
+    def test_source_rewritten_after_load(self):
+        copy_path = os.path.join(self.test_files_dir, 'test_incremental_source.pdf')
+        self.addCleanup(os.remove, copy_path)
+        for use_mmap in (False, True):
+            with open(self.source_path, 'rb') as source, open(copy_path, 'wb') as target:
+                target.write(source.read())
+            factx = FacturX(copy_path, use_mmap=use_mmap)
+            factx['invoice_number'] = 'INC-0003'
+            factx.write_pdf(copy_path)
+            factx.write_pdf(self.test_file_path, incremental=True)
+            self.assertEqual(FacturX(self.test_file_path)['invoice_number'], 'INC-0003')
+            factx.close()
+
+    def test_append_to_changed_file(self):
+        with open(self.source_path, 'rb') as f:
+            original = f.read()
+        with open(self.test_file_path, 'wb') as f:
+            f.write(original)
+        factx = FacturX(self.test_file_path)
+        # Same size, but another startxref.
+        with open(self.test_file_path, 'wb') as f:
+            f.write(original.replace(b'startxref', b'startxrex'))
+        self.assertRaises(ValueError, factx.write_pdf, self.test_file_path, incremental=True)
+
+
+class TestXmpTemplate(unittest.TestCase):
+    def setUp(self):
+        self._get_metadata_timestamp = pdfwriter._get_metadata_timestamp
+        pdfwriter._get_metadata_timestamp = lambda: '2018-10-10T10:10:10+00:00'
+
+    def tearDown(self):
+        pdfwriter._get_metadata_timestamp = self._get_metadata_timestamp
+
+    def test_template_matches_builder(self):
+        test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        for file_name in ('Facture_FR_MINIMUM.pdf', 'Facture_FR_EN16931.pdf'):
+            flavor = FacturX(os.path.join(test_files_dir, file_name)).flavor
+            for pdf_metadata in ({'title': u'Smith & <Sons> \xe9', 'author': 'A "B"', 'subject': 'x\ny'},
+                                 {}, {'title': None}, {'subject': 'carriage\rreturn'}):
+                expected = pdfwriter._prepare_pdf_metadata_xml(
+                    flavor.details['levels'][flavor.level]['xmp_str'],
+                    flavor.details['xmp_filename'],
+                    flavor.get_xmp_xml(),
+                    pdf_metadata)
+                self.assertEqual(pdfwriter._render_pdf_metadata_xml(flavor, pdf_metadata), expected)
+
+
+class TestCodeLists(unittest.TestCase):
+    def test_matches_pycountry_lookup(self):
+        import pycountry
+        flavor = FacturX(os.path.join(os.path.dirname(__file__), 'sample_invoices', 'embedded_data.pdf')).flavor
+        for code_type, database in (('country', pycountry.countries), ('currency', pycountry.currencies)):
+            for value in ('FR', 'fr', 'FRA', 'France', 'EUR', 'eur', '978', 'Euro', 'XX', 'nowhere'):
+                try:
+                    database.lookup(value)
+                    expected = True
+                except LookupError:
+                    expected = False
+                self.assertEqual(flavor.valid_code(code_type, value), expected, (code_type, value))
+
+    def test_register_code_list(self):
+        from facturx.flavors import codes
+        codes.register_code_list('document_type', lambda: ['380', '381'])
+        try:
+            self.assertIn('381', codes.get_code_list('document_type'))
+            self.assertNotIn('999', codes.get_code_list('document_type'))
+        finally:
+            del codes._CODE_LISTS['document_type']
+
+
+class TestFieldMapsCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_home = tempfile.mkdtemp(prefix='facturx-test-')
+        patcher = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_home})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.cache_home)
+
+    def test_json_cache_follows_yml(self):
+        package_dir = os.path.dirname(xml_flavor.__file__)
+        data = xml_flavor._load_yml('flavors.yml')
+        cache_name, = os.listdir(os.path.join(self.cache_home, 'factur-x'))
+        self.assertTrue(cache_name.startswith('flavors.yml-'))
+        cache_path = os.path.join(self.cache_home, 'factur-x', cache_name)
+        self.assertFalse(os.path.exists(os.path.join(package_dir, '__pycache__', 'flavors.yml.json')))
+        self.assertEqual(xml_flavor._load_yml('flavors.yml'), data)
+
+        # A stale cache is ignored and rewritten
+        with open(cache_path, 'w') as f:
+            f.write('{"signature": [0, 0], "data": {}}')
+        self.assertEqual(xml_flavor._load_yml('flavors.yml'), data)
+        self.assertEqual(xml_flavor._load_yml('flavors.yml'), data)
+        self.assertIn('factur-x', xml_flavor.FLAVORS)
+
+    def test_unwritable_cache_dir(self):
+        blocker = os.path.join(self.cache_home, 'blocker')
+        open(blocker, 'w').close()
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': blocker}):
+            self.assertIn('factur-x', xml_flavor._load_yml('flavors.yml'))
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.test_file_path = os.path.join(self.test_files_dir, 'test_instrument.pdf')
+        self.tracer = instrument.StatsTracer()
+        self.previous = instrument.set_tracer(self.tracer)
+
+    def tearDown(self):
+        instrument.set_tracer(self.previous)
+        if os.path.exists(self.test_file_path):
+            os.remove(self.test_file_path)
+
+    def test_stages_are_recorded(self):
+        source_path = os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')
+        factx = FacturX(source_path)
+        factx.is_valid()
+        factx.to_dict()
+        factx.write_pdf(self.test_file_path)
+
+        for name in ('pdf.read', 'pdf.parse', 'pdf.extract', 'xml.parse', 'xsd.validate',
+                     'validate', 'fields.read', 'fields.to_dict', 'xmp.build',
+                     'pdf.write', 'pdf.serialize'):
+            self.assertIn(name, self.tracer.spans)
+        self.assertEqual(self.tracer.spans['validate']['calls'], 1)
+        self.assertEqual(self.tracer.counters['bytes.read'], os.path.getsize(source_path))
+        self.assertEqual(self.tracer.counters['bytes.written'], os.path.getsize(self.test_file_path))
+
+    def test_errors_are_counted(self):
+        with self.assertRaises(ValueError):
+            with instrument.span('custom'):
+                raise ValueError()
+        self.assertEqual(self.tracer.spans['custom']['errors'], 1)
+
+    def test_disabled_by_default(self):
+        instrument.set_tracer(None)
+        self.assertIs(instrument.span('a'), instrument.span('b'))
+        instrument.count('bytes.read', 1)
+        self.assertEqual(self.tracer.counters, {})
+
+
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.test_file_path = os.path.join(self.test_files_dir, 'test_async.pdf')
+
+    def tearDown(self):
+        from facturx import aio
+        aio.set_concurrency(os.cpu_count() or 1)
+        if os.path.exists(self.test_file_path):
+            os.remove(self.test_file_path)
+
+    def test_open_validate_write(self):
+        async def process():
+            factx = await FacturX.aopen(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+            await factx.ais_valid()
+            await factx.awrite_pdf(self.test_file_path)
+            return factx
+
+        factx = asyncio.run(process())
+        self.assertEqual(FacturX(self.test_file_path).xml_str, factx.xml_str)
+
+    def test_concurrency_is_bounded(self):
+        from facturx import aio
+        aio.set_concurrency(2)
+        state = {'running': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            threading.Event().wait(0.02)
+            with lock:
+                state['running'] -= 1
+
+        async def burst():
+            await asyncio.gather(*[aio.run(work) for i in range(8)])
+
+        asyncio.run(burst())
+        self.assertEqual(state['peak'], 2)
+
+    def test_cancelled_call_keeps_its_permit(self):
+        from facturx import aio
+        aio.set_concurrency(1)
+        started = threading.Event()
+        finish = threading.Event()
+
+        def work():
+            started.set()
+            finish.wait(5)
+
+        async def cancel_running_call():
+            semaphore = aio._get_semaphore(asyncio.get_running_loop())
+            task = asyncio.ensure_future(aio.run(work))
+            while not started.is_set():
+                await asyncio.sleep(0.001)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertTrue(semaphore.locked())
+            finish.set()
+            await aio.run(lambda: None)
+            self.assertFalse(semaphore.locked())
+
+        asyncio.run(cancel_running_call())
+
+    def test_new_limit_applies_to_new_loops(self):
+        from facturx import aio
+        aio.set_concurrency(2)
+
+        async def change_limit():
+            await aio.run(lambda: None)
+            semaphore = aio._get_semaphore(asyncio.get_running_loop())
+            aio.set_concurrency(1)
+            self.assertIs(aio._get_semaphore(asyncio.get_running_loop()), semaphore)
+            await aio.run(lambda: None)
+            return semaphore._value
+
+        self.assertEqual(asyncio.run(change_limit()), 2)
+
+        async def new_loop():
+            await aio.run(lambda: None)
+            return aio._get_semaphore(asyncio.get_running_loop())._value
+
+        self.assertEqual(asyncio.run(new_loop()), 1)
+
+
+class TestGroupBuilder(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+
+    def test_line_items_in_xsd_order(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'no_embedded_data.pdf'), level='en16931')
+        items = [{'line_id': i, 'name': 'Item %d' % i, 'net_price': '10.00', 'quantity': 2,
+                  'amount_total': '20.00', 'tax_category_code': 'S', 'tax_rate': '20.00'}
+                 for i in range(1, 101)]
+        self.assertEqual(factx.add_line_items(items, replace=True), 100)
+        self.assertEqual(factx.add_tax_lines([{'calculated_amount': '400.00', 'basis_amount': '2000.00',
+                                               'category_code': 'S', 'rate': '20.00'}]), 1)
+        factx.flavor.check_xsd(factx.xml)
+
+        ns = xml_flavor.FLAVORS['factur-x']['namespaces']
+        line_ids = factx.xml.xpath('//ram:IncludedSupplyChainTradeLineItem'
+                                   '/ram:AssociatedDocumentLineDocument/ram:LineID/text()', namespaces=ns)
+        self.assertEqual(line_ids, [str(i) for i in range(1, 101)])
+        quantity = factx.xml.xpath('//ram:BilledQuantity', namespaces=ns)[0]
+        self.assertEqual(quantity.get('unitCode'), 'C62')
+        self.assertEqual(len(factx.xml.xpath('//ram:ApplicableHeaderTradeSettlement/ram:ApplicableTradeTax',
+                                             namespaces=ns)), 2)
+        self.assertNotIn(b'ns0', factx.xml_str)
+
+    def test_bad_items(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'no_embedded_data.pdf'), level='en16931')
+        with self.assertRaises(ValueError):
+            factx.add_tax_lines([{'rate': '20.00'}])
+        with self.assertRaises(ValueError):
+            factx.add_tax_lines([{'calculated_amount': '1', 'basis_amount': '5', 'category_code': 'S',
+                                  'vat': '20.00'}])
+
+    def test_no_line_items_below_basic(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'no_embedded_data.pdf'), level='minimum')
+        with self.assertRaises(ValueError):
+            factx.add_line_items([{'line_id': 1, 'name': 'Item', 'net_price': '10.00', 'quantity': 1,
+                                   'amount_total': '10.00', 'tax_category_code': 'S', 'tax_rate': '20.00'}])
+        factx.flavor.check_xsd(factx.xml)
+
+    def test_registry_toggles(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'no_embedded_data.pdf'), level='en16931')
+        element = factx.xml[0]
+        factx._save_to_registry(element, 'parent')
+        self.assertEqual(factx.already_added_field['parent'], set())
+        factx._save_to_registry(element, 'parent')
+        self.assertIn(element, factx.already_added_field['parent'])
+        factx._save_to_registry(element, 'parent')
+        self.assertNotIn(element, factx.already_added_field['parent'])
+
+
+class TestTotals(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+
+    def test_columns(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+        lines = factx.line_items()
+        self.assertEqual(set(len(column) for column in lines.values()), {3})
+        self.assertEqual(sum(lines['amount_total']), Decimal(factx['amount_untaxed']))
+        self.assertIsInstance(lines['quantity'][0], Decimal)
+        self.assertIsInstance(lines['name'][0], str)
+        self.assertEqual(factx.tax_lines(['rate'])['rate'], [Decimal('20.00'), Decimal('5.50')])
+        self.assertEqual(factx.check_totals(), [])
+
+    def test_missing_values_stay_aligned(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'no_embedded_data.pdf'), level='en16931')
+        factx.add_line_items([{'line_id': i, 'name': 'Item %d' % i, 'net_price': '10.00', 'quantity': 1,
+                               'amount_total': '10.00', 'gross_price': '12.00' if i == 2 else None}
+                              for i in range(1, 4)], replace=True)
+        self.assertEqual(factx.line_items(['gross_price'])['gross_price'], [None, Decimal('12.00'), None])
+        self.assertRaises(ValueError, factx.line_items, ['vat'])
+
+    def test_inconsistent_totals(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+        ns = xml_flavor.FLAVORS['factur-x']['namespaces']
+        factx.xml.xpath('//ram:LineTotalAmount', namespaces=ns)[0].text = '1.00'
+        factx.xml.xpath('//ram:ApplicableTradeTax/ram:CalculatedAmount', namespaces=ns)[0].text = '16.40'
+        errors = factx.check_totals()
+        self.assertEqual(len(errors), 3)
+        with self.assertLogs('factur-x', level='WARNING'):
+            self.assertFalse(factx.is_valid())
+
+
+class TestValidationCache(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.tracer = instrument.StatsTracer()
+        self.previous = instrument.set_tracer(self.tracer)
+
+    def tearDown(self):
+        instrument.set_tracer(self.previous)
+
+    def check_cache(self, cache):
+        path = os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')
+        expected = FacturX(path).is_valid()
+        self.assertEqual(FacturX(path).is_valid(cache=cache), expected)
+        self.assertEqual(len(cache), 1)
+        self.assertNotIn('validate.cache_hits', self.tracer.counters)
+
+        factx = FacturX(path)
+        with self.assertLogs('factur-x', 'WARNING') as logs:
+            self.assertEqual(factx.is_valid(cache=cache), expected)
+        self.assertEqual(self.tracer.counters['validate.cache_hits'], 1)
+        with self.assertLogs('factur-x', 'WARNING') as uncached_logs:
+            FacturX(path).is_valid()
+        self.assertEqual(logs.output, uncached_logs.output)
+
+        # Defaults written to missing fields are applied again on a hit
+        template = FacturX(os.path.join(self.test_files_dir, 'no_embedded_data.pdf'))
+        template.is_valid(cache=cache)
+        template = FacturX(os.path.join(self.test_files_dir, 'no_embedded_data.pdf'))
+        template.is_valid(cache=cache)
+        self.assertEqual(template['currency'], 'EUR')
+        self.assertEqual(self.tracer.counters['validate.cache_hits'], 2)
+
+    def test_memory_cache(self):
+        from facturx import validation_cache
+        cache = validation_cache.MemoryValidationCache(max_entries=2)
+        self.check_cache(cache)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, {'valid': True, 'warnings': [], 'defaults': []})
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('a'))
+
+    def test_sqlite_cache(self):
+        import tempfile
+        from facturx import validation_cache
+        with tempfile.TemporaryDirectory() as directory:
+            cache = validation_cache.SqliteValidationCache(
+                os.path.join(directory, 'cache.sqlite'), max_entries=2, evict_every=1)
+            self.check_cache(cache)
+            for key in ('a', 'b', 'c'):
+                cache.set(key, {'valid': True, 'warnings': [], 'defaults': []})
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.get('c'), {'valid': True, 'warnings': [], 'defaults': []})
+
+            thread = threading.Thread(target=cache.get, args=('c',))
+            thread.start()
+            thread.join()
+            connections = list(cache._connections)
+            self.assertEqual(len(connections), 2)
+            cache.close()
+            for connection in connections:
+                self.assertRaises(sqlite3.ProgrammingError, connection.execute, 'SELECT 1')
+            # Usable again after close()
+            self.assertEqual(len(cache), 2)
+            cache.close()
+
+    def test_xsd_invalid_hit_logs_the_same_warnings(self):
+        from facturx import validation_cache
+        cache = validation_cache.MemoryValidationCache()
+
+        def invalid_invoice():
+            factx = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+            factx.xml.find('{*}ExchangedDocument').addprevious(etree.Element('Unexpected'))
+            return factx
+
+        with self.assertLogs('factur-x', 'WARNING') as uncached_logs:
+            self.assertFalse(invalid_invoice().is_valid())
+        with self.assertLogs('factur-x', 'WARNING') as miss_logs:
+            self.assertFalse(invalid_invoice().is_valid(cache=cache))
+        with self.assertLogs('factur-x', 'WARNING') as hit_logs:
+            self.assertFalse(invalid_invoice().is_valid(cache=cache))
+        self.assertEqual(self.tracer.counters['validate.cache_hits'], 1)
+        self.assertEqual(len(uncached_logs.output), 2)
+        self.assertEqual(miss_logs.output, uncached_logs.output)
+        self.assertEqual(hit_logs.output, uncached_logs.output)
+
+    def test_key_ignores_serialization(self):
+        from facturx import validation_cache
+        xml = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')).xml
+        reparsed = etree.fromstring(etree.tostring(xml, pretty_print=False))
+        self.assertEqual(validation_cache.make_key(xml, 'factur-x', 'en16931'),
+                         validation_cache.make_key(reparsed, 'factur-x', 'en16931'))
+        self.assertNotEqual(validation_cache.make_key(xml, 'factur-x', 'en16931'),
+                            validation_cache.make_key(xml, 'factur-x', 'basic'))
+        self.assertEqual(validation_cache.make_key(etree.fromstring("<a b='1'>&#233;<c></c></a>"), 'f', 'l'),
+                         validation_cache.make_key(etree.fromstring('<a b="1">\u00e9<c/></a>'), 'f', 'l'))
+
+
+class TestTemplateCache(unittest.TestCase):
+    def test_copies_are_independent(self):
+        flavor, xml = xml_flavor.XMLFlavor.from_template('factur-x', 'en16931')
+        other_flavor, other_xml = xml_flavor.XMLFlavor.from_template('factur-x', 'en16931')
+        self.assertIsNot(xml, other_xml)
+        self.assertIsNot(flavor, other_flavor)
+        self.assertEqual((other_flavor.name, other_flavor.level), ('factur-x', 'en16931'))
+
+        xml[0].clear()
+        self.assertEqual(etree.tostring(other_xml),
+                         etree.tostring(xml_flavor.XMLFlavor.from_template('factur-x', 'en16931')[1]))
+        self.assertNotEqual(etree.tostring(xml), etree.tostring(other_xml))
+
+
+class TestCompressedXml(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.test_file_path = os.path.join(self.test_files_dir, 'test_compressed.pdf')
+
+    def tearDown(self):
+        if os.path.exists(self.test_file_path):
+            os.remove(self.test_file_path)
+
+    def embedded_file(self):
+        with open(self.test_file_path, 'rb') as f:
+            pdf = pdfreader.PdfFileReader(f)
+            names = pdf.trailer['/Root']['/Names']['/EmbeddedFiles']['/Names']
+            embedded = names[1].getObject()['/EF']['/F'].getObject()
+            return embedded, pdf.trailer['/Root']['/Metadata'].getObject()
+
+    def test_checksum_and_compression(self):
+        import hashlib
+        factx = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+        for incremental in (False, True):
+            for compress_level in (None, 9):
+                factx.write_pdf(self.test_file_path, incremental=incremental, compress_level=compress_level)
+                embedded, metadata = self.embedded_file()
+                self.assertEqual(embedded['/Params']['/CheckSum'], hashlib.md5(factx.xml_str).hexdigest())
+                self.assertEqual(int(embedded['/Params']['/Size']), len(factx.xml_str))
+                self.assertEqual(embedded.get('/Filter'), '/FlateDecode' if compress_level else None)
+                self.assertNotIn('/Filter', metadata)
+                self.assertEqual(FacturX(self.test_file_path).xml_str, factx.xml_str)
+
+    def test_digest_in_chunks(self):
+        import hashlib
+        import zlib
+        data = b'<a>' + b'x' * 100000 + b'</a>'
+        md5sum, size, compressed = pdfwriter._digest_and_compress(data, 6, chunk_size=4096)
+        self.assertEqual((md5sum, size), (hashlib.md5(data).hexdigest(), len(data)))
+        self.assertEqual(zlib.decompress(compressed), data)
+        self.assertIs(pdfwriter._digest_and_compress(data)[2], data)
+        for compress_level in (-1, 0, 10):
+            self.assertRaises(ValueError, pdfwriter._digest_and_compress, data, compress_level)
+
+
+class TestXmlParser(unittest.TestCase):
+    def test_entities_are_not_expanded(self):
+        from facturx import xmlparser
+        laughs = (b'<?xml version="1.0"?><!DOCTYPE lolz [<!ENTITY lol "lol">'
+                  b'<!ENTITY lol2 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">'
+                  b'<!ENTITY lol3 "&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;">]>'
+                  b'<lolz>&lol3;</lolz>')
+        self.assertNotIn(b'lollol', etree.tostring(xmlparser.fromstring(laughs)))
+        external = (b'<?xml version="1.0"?><!DOCTYPE x [<!ENTITY ext SYSTEM "file://%s">]><x>&ext;</x>'
+                    % os.path.abspath(__file__).encode('utf-8'))
+        self.assertNotIn(b'unittest', etree.tostring(xmlparser.fromstring(external)))
+
+    def test_size_limit(self):
+        import io
+        from facturx import xmlparser
+        data = b'<a>' + b'x' * 1000 + b'</a>'
+        previous, xmlparser.MAX_SIZE = xmlparser.MAX_SIZE, 100
+        try:
+            self.assertRaises(ValueError, xmlparser.fromstring, data)
+            self.assertRaises(ValueError, xmlparser.parse, io.BytesIO(data))
+        finally:
+            xmlparser.MAX_SIZE = previous
+        self.assertEqual(len(xmlparser.parse(io.BytesIO(data)).text), 1000)
+
+    def test_parser_per_thread(self):
+        from facturx import xmlparser
+        parsers = []
+        thread = threading.Thread(target=lambda: parsers.append(xmlparser.get_parser()))
+        thread.start()
+        thread.join()
+        self.assertIs(xmlparser.get_parser(), xmlparser.get_parser())
+        self.assertIsNot(parsers[0], xmlparser.get_parser())
+
+
+class TestLazyOpen(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.test_file_path = os.path.join(self.test_files_dir, 'test_lazy.pdf')
+        self.tracer = instrument.StatsTracer()
+        self.previous = instrument.set_tracer(self.tracer)
+
+    def tearDown(self):
+        instrument.set_tracer(self.previous)
+        if os.path.exists(self.test_file_path):
+            os.remove(self.test_file_path)
+
+    def test_open_defers_validation(self):
+        path = os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')
+        factx = FacturX.open(path)
+        self.assertEqual((factx.flavor.name, factx.flavor.level), ('factur-x', 'en16931'))
+        self.assertEqual(factx['invoice_number'], 'FA-2017-0010')
+        self.assertNotIn('xsd.validate', self.tracer.spans)
+        self.assertEqual(factx.is_valid(), FacturX(path).is_valid())
+        self.assertIn('xsd.validate', self.tracer.spans)
+
+    def test_open_invalid_xml(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+        factx.xml.find('{*}ExchangedDocument').addprevious(etree.Element('Unexpected'))
+        with open(self.test_file_path, 'wb') as f:
+            pdfwriter.FacturXIncrementalWriter(factx).write(f)
+        self.assertRaises(Exception, FacturX, self.test_file_path)
+        factx = FacturX.open(self.test_file_path)
+        self.assertEqual(factx['invoice_number'], 'FA-2017-0010')
+        self.assertFalse(factx.is_valid())
+
+    def test_peek(self):
+        path = os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')
+        peeked = FacturX.peek(path, ['invoice_number', 'seller_name'])
+        self.assertEqual(peeked, {'flavor': 'factur-x', 'level': 'en16931', 'fields': {
+            'invoice_number': 'FA-2017-0010', 'seller_name': 'Au bon moulin'}})
+        with open(path, 'rb') as f:
+            self.assertEqual(FacturX.peek(f)['fields'], FacturX(path).to_dict())
+        self.assertIsNone(FacturX.peek(os.path.join(self.test_files_dir, 'no_embedded_data.pdf')))
+
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.test_file_path = os.path.join(self.test_files_dir, 'test_stream.pdf')
+
+    def tearDown(self):
+        if os.path.exists(self.test_file_path):
+            os.remove(self.test_file_path)
+
+    def test_events(self):
+        path = os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')
+        factx = FacturX(path)
+        events = list(FacturX.stream(path))
+        self.assertEqual([kind for kind, data in events],
+                         ['header', 'line_item', 'line_item', 'line_item', 'trade'])
+        header, trade = events[0][1], events[-1][1]
+        self.assertEqual((header['flavor'], header['level']), ('factur-x', 'en16931'))
+        self.assertEqual(header['fields']['invoice_number'], 'FA-2017-0010')
+        self.assertIn('seller_name', trade)
+        self.assertEqual(dict(header['fields'], **trade), factx.to_dict())
+        self.assertEqual([data['name'] for kind, data in events[1:-1]], factx.line_items(['name'])['name'])
+
+    def test_compressed_in_small_chunks(self):
+        factx = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+        factx.add_line_items([{'line_id': i, 'name': 'Item %d' % i, 'net_price': '10.00', 'quantity': 1,
+                               'amount_total': '10.00'} for i in range(1, 201)], replace=True)
+        factx.write_pdf(self.test_file_path, compress_level=6)
+        line_ids = [data['line_id'] for kind, data in FacturX.stream(self.test_file_path, chunk_size=256)
+                    if kind == 'line_item']
+        self.assertEqual(line_ids, [str(i) for i in range(1, 201)])
+
+    def test_no_xml(self):
+        with self.assertRaises(ValueError):
+            list(FacturX.stream(os.path.join(self.test_files_dir, 'no_embedded_data.pdf')))
+
+
+class _FakePdf(object):
+    def __init__(self, root):
+        self.trailer = {'/Root': root}
+
+
+class TestEmbeddedFileLookup(unittest.TestCase):
+    def filespec(self, key, filename=None):
+        stream = DecodedStreamObject()
+        stream.setData(key.encode('ascii'))
+        return DictionaryObject({
+            NameObject('/F'): createStringObject(filename or key),
+            NameObject('/EF'): DictionaryObject({NameObject('/F'): stream}),
+        })
+
+    def node(self, keys=None, kids=None, filenames=None):
+        node = DictionaryObject()
+        if keys is not None:
+            names = ArrayObject()
+            for key in keys:
+                names += [createStringObject(key), self.filespec(key, (filenames or {}).get(key))]
+            node[NameObject('/Names')] = names
+            limits = (keys[0], keys[-1])
+        else:
+            node[NameObject('/Kids')] = ArrayObject(kids)
+            limits = (kids[0]['/Limits'][0], kids[-1]['/Limits'][1])
+        node[NameObject('/Limits')] = ArrayObject([createStringObject(limit) for limit in limits])
+        return node
+
+    def pdf(self, tree=None, af=None):
+        root = DictionaryObject()
+        if tree is not None:
+            root[NameObject('/Names')] = DictionaryObject({NameObject('/EmbeddedFiles'): tree})
+        if af is not None:
+            root[NameObject('/AF')] = ArrayObject(af)
+        return _FakePdf(root)
+
+    def test_kids(self):
+        keys = sorted(['attachment-%03d.pdf' % i for i in range(300)] + ['factur-x.xml'])
+        leaves = [self.node(keys[i:i + 50]) for i in range(0, len(keys), 50)]
+        tree = DictionaryObject({NameObject('/Kids'): ArrayObject(
+            [self.node(kids=leaves[:3]), self.node(kids=leaves[3:])])})
+        for key in keys:
+            self.assertEqual(pdfreader._name_tree_lookup(tree, key)['/F'], key)
+        self.assertIsNone(pdfreader._name_tree_lookup(tree, 'zzz.xml'))
+        self.assertEqual(pdfreader.get_embedded_file(self.pdf(tree)).getData(), b'factur-x.xml')
+
+    def test_associated_files(self):
+        pdf = self.pdf(af=[self.filespec('other.pdf'), self.filespec('factur-x.xml')])
+        self.assertEqual(pdfreader.get_embedded_file(pdf).getData(), b'factur-x.xml')
+
+    def test_key_differs_from_filename(self):
+        tree = self.node(['attachment', 'invoice'], filenames={'invoice': 'factur-x.xml'})
+        self.assertEqual(pdfreader.get_embedded_file(self.pdf(tree)).getData(), b'invoice')
+        self.assertIsNone(pdfreader.get_embedded_file(self.pdf(self.node(['attachment']))))
+
+
 def main():
     unittest.main()
 
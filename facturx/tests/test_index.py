@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+from facturx import batch
+from facturx.facturx import *
+from facturx.index import InvoiceIndex
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        self.work_dir = tempfile.mkdtemp(prefix='facturx-test-')
+        for name in ('Facture_FR_EN16931.pdf', 'Facture_UE_BASIC.pdf', 'no_embedded_data.pdf'):
+            shutil.copy(os.path.join(self.test_files_dir, name), self.work_dir)
+        self.index = InvoiceIndex(os.path.join(self.work_dir, 'index.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.work_dir)
+
+    def update(self, **kwargs):
+        return self.index.update(batch.expand_paths([self.work_dir]), processes=1, **kwargs)
+
+    def test_typed_fields(self):
+        self.assertEqual(self.update(), {'indexed': 2, 'unchanged': 0, 'errors': 1})
+        pdf_path = os.path.join(self.work_dir, 'Facture_FR_EN16931.pdf')
+        expected = FacturX(pdf_path).to_dict()
+        result, = self.index.query(number=expected['invoice_number'])
+        self.assertEqual(result['path'], pdf_path)
+        fields = result['fields']
+        self.assertEqual(fields['seller_name'], expected['seller_name'])
+        self.assertEqual(fields['date'].replace('-', ''), expected['date'])
+        self.assertEqual(fields['amount_total'], str(Decimal(expected['amount_total'])))
+
+        seller = expected['seller_name'][:4].lower()
+        self.assertIn(pdf_path, [r['path'] for r in self.index.query(seller=seller)])
+        amount = Decimal(fields['amount_total'])
+        self.assertEqual(self.index.query(amount_min=amount + Decimal('0.01'), number=expected['invoice_number']), [])
+        self.assertEqual(len(self.index.query(amount_min=amount, amount_max=amount,
+                                              number=expected['invoice_number'])), 1)
+        self.assertEqual(len(self.index.query(date_from=fields['date'], date_to=fields['date'],
+                                              currency=expected['currency'])), 1)
+        self.assertRaises(ValueError, self.index.query, no_such_field='x')
+
+        # Field values are given as in to_dict(), and decimals match by value.
+        self.assertEqual(len(self.index.query(date=expected['date'], amount_total=str(amount) + '000',
+                                              number=expected['invoice_number'])), 1)
+        self.assertRaises(ValueError, self.index.query, date='01/01/2018')
+        self.assertRaises(ValueError, self.index.query, amount_min='ten')
+
+    def test_incremental(self):
+        self.update()
+        self.assertEqual(self.update(), {'indexed': 0, 'unchanged': 3, 'errors': 0})
+
+        pdf_path = os.path.join(self.work_dir, 'Facture_UE_BASIC.pdf')
+        os.utime(pdf_path, ns=(0, 0))
+        self.assertEqual(self.update(use_hash=True)['indexed'], 1)
+        os.utime(pdf_path)
+        self.assertEqual(self.update(use_hash=True), {'indexed': 0, 'unchanged': 3, 'errors': 0})
+
+        os.remove(pdf_path)
+        self.assertEqual(self.index.prune(), 1)
+        self.assertEqual(len(self.index), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from facturx import server
+from facturx.facturx import *
+
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_files_dir = os.path.join(os.path.dirname(__file__), 'sample_invoices')
+        cls.work_dir = tempfile.mkdtemp(prefix='facturx-test-')
+        cls.socket_path = os.path.join(cls.work_dir, 'facturx.sock')
+        cls.server = server.FacturXServer(cls.socket_path, processes=1)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+        cls.server.server_close()
+        shutil.rmtree(cls.work_dir)
+
+    def test_socket_is_private(self):
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+
+    def test_default_socket_dir(self):
+        from unittest import mock
+        with mock.patch.dict(os.environ), mock.patch.object(tempfile, 'tempdir', self.work_dir):
+            os.environ.pop('XDG_RUNTIME_DIR', None)
+            directory = os.path.dirname(server._default_socket())
+            self.assertEqual(os.path.dirname(directory), self.work_dir)
+            server._prepare_socket_dir(directory)
+            self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+            os.chmod(directory, 0o777)
+            self.assertRaises(ValueError, server._prepare_socket_dir, directory)
+
+    def test_validate_and_dump(self):
+        path = os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf')
+        with server.Client(self.socket_path) as client:
+            response = client.call('validate', path, id=1)
+            self.assertEqual(response['id'], 1)
+            self.assertEqual(response['result'], {'valid': FacturX(path).is_valid()})
+            self.assertEqual(client.call('dump', path)['result'], FacturX(path).to_dict())
+
+    def test_embed(self):
+        source = FacturX(os.path.join(self.test_files_dir, 'Facture_FR_EN16931.pdf'))
+        xml_path = os.path.join(self.work_dir, 'metadata.xml')
+        output_path = os.path.join(self.work_dir, 'embedded.pdf')
+        source.write_xml(xml_path)
+        with server.Client(self.socket_path) as client:
+            response = client.call('embed', os.path.join(self.test_files_dir, 'no_embedded_data.pdf'),
+                                   xml=xml_path, output=output_path)
+        self.assertTrue(response['ok'], response)
+        self.assertEqual(FacturX(output_path).xml_str, source.xml_str)
+
+    def test_errors(self):
+        with server.Client(self.socket_path) as client:
+            self.assertFalse(client.call('validate', 'missing.pdf')['ok'])
+            self.assertIn('Unknown operation', client.call('delete', 'missing.pdf')['error'])
+
+    def test_second_server_is_refused(self):
+        with self.assertRaises(ValueError):
+            server.FacturXServer(self.socket_path, processes=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Arithmetic consistency checks of the invoice totals (EN16931).
+
+- BR-CO-10: the line net amounts add up to LineTotalAmount (amount_untaxed)
+- BR-CO-14: the VAT breakdown amounts add up to TaxTotalAmount (amount_tax)
+- each VAT breakdown amount is its basis times its rate, rounded to
+  cents, give or take ROUNDING_TOLERANCE for tools rounding differently
+
+Amounts are read as columns (see flavors/columns.py) and summed as
+decimal.Decimal in a context wide enough for additions and products to
+be exact. Checks whose values are missing, like line sums of levels
+without lines, are skipped.
+"""
+
+import decimal
+from decimal import Decimal
+
+ROUNDING_TOLERANCE = Decimal('0.01')
+
+_CENT = Decimal('0.01')
+_EXACT = decimal.Context(prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX, Emin=decimal.MIN_EMIN)
+
+
+def _sum(values):
+    if not values or None in values:
+        return None
+    with decimal.localcontext(_EXACT):
+        return sum(values, Decimal(0))
+
+
+def _header_amount(text):
+    if not text:
+        return None
+    try:
+        return Decimal(text)
+    except decimal.InvalidOperation:
+        return None
+
+
+def check_totals(line_items, tax_lines, amount_untaxed, amount_tax):
+    """Return the list of inconsistencies between lines, breakdown and totals.
+
+    line_items and tax_lines are the columns of the line_items and
+    tax_lines groups; amount_untaxed and amount_tax the texts of the
+    header fields.
+    """
+    errors = []
+    expected = _header_amount(amount_untaxed)
+    total = _sum(line_items.get('amount_total'))
+    if expected is not None and total is not None and total != expected:
+        errors.append('Line amounts add up to %s, amount_untaxed is %s' % (total, expected))
+
+    expected = _header_amount(amount_tax)
+    total = _sum(tax_lines.get('calculated_amount'))
+    if expected is not None and total is not None and total != expected:
+        errors.append('VAT breakdown amounts add up to %s, amount_tax is %s' % (total, expected))
+
+    with decimal.localcontext(_EXACT):
+        for i, (basis, rate, amount) in enumerate(zip(
+                tax_lines.get('basis_amount', []), tax_lines.get('rate', []),
+                tax_lines.get('calculated_amount', [])), 1):
+            if basis is None or rate is None or amount is None:
+                continue
+            computed = (basis * rate).scaleb(-2).quantize(_CENT, rounding=decimal.ROUND_HALF_UP)
+            if abs(computed - amount) > ROUNDING_TOLERANCE:
+                errors.append('VAT breakdown %d: %s%% of %s is %s, not %s' % (i, rate, basis, computed, amount))
+    return errors
@@ -0,0 +1,160 @@
+"""
+Caches of FacturX.is_valid() results keyed by document content.
+
+The key is a SHA-256 digest of the XML tree, re-serialized by lxml,
+together with the flavor and level. Re-serializing the parsed tree
+normalizes quoting, character references and empty elements, so the
+same document hits the cache whatever bytes it was parsed from. An
+entry holds the result, the warnings logged while validating and the
+defaults written to missing required fields; on a hit
+is_valid() applies the same defaults and logs the same warnings without
+running the checks again.
+
+Two backends share the get()/set() interface: MemoryValidationCache, a
+per-process LRU, and SqliteValidationCache, persistent and shared between
+processes. Both evict the least recently used entries beyond max_entries.
+
+    FacturX.validation_cache = SqliteValidationCache('/var/cache/facturx.sqlite')
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from lxml import etree
+
+# Part of every key: bump it when validation rules change, so that
+# persistent caches do not return results computed by older rules.
+KEY_VERSION = 3
+
+
+def make_key(xml, flavor, level):
+    """Return the cache key of the XML tree xml for flavor and level."""
+    digest = hashlib.sha256()
+    digest.update(('%d\0%s\0%s\0' % (KEY_VERSION, flavor, level)).encode('utf-8'))
+    # C14N would also normalize attribute order and namespace
+    # declarations, but costs as much as validating the document.
+    digest.update(etree.tostring(xml, encoding='utf-8'))
+    return digest.hexdigest()
+
+
+class MemoryValidationCache(object):
+    """In-memory LRU cache of validation results."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteValidationCache(object):
+    """Validation results stored in a sqlite database at path.
+
+    Safe to share between threads and processes. Entries beyond
+    max_entries are evicted by last use, checked every evict_every writes.
+    Each thread gets its own connection; close() closes all of them.
+    """
+
+    def __init__(self, path, max_entries=100000, evict_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS validation ('
+                'key TEXT PRIMARY KEY, entry TEXT NOT NULL, last_used REAL NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS validation_last_used ON validation (last_used)')
+
+    def _connect(self):
+        # sqlite3 connections may not be shared between threads.
+        # They are only closed from another thread by close().
+        local = self._local
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the connections of all threads; later calls open new ones."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for connection in connections:
+            connection.close()
+
+    def get(self, key):
+        connection = self._connect()
+        row = connection.execute('SELECT entry FROM validation WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with connection:
+            connection.execute('UPDATE validation SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, entry):
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO validation (key, entry, last_used) VALUES (?, ?, ?)',
+                (key, json.dumps(entry), time.time()))
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries beyond max_entries."""
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                'DELETE FROM validation WHERE key IN ('
+                'SELECT key FROM validation ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def clear(self):
+        connection = self._connect()
+        with connection:
+            connection.execute('DELETE FROM validation')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM validation').fetchone()[0]
@@ -15,13 +15,14 @@ setup(
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'License :: OSI Approved :: BSD License',
         "Operating System :: OS Independent",
     ],
+    python_requires='>=3.7',
     keywords='e-invoice ZUGFeRD Factur-X Chorus',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires=[r.strip() for r in
                       open('requirement.txt').read().splitlines()],
     include_package_data=True,